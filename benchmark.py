@@ -0,0 +1,508 @@
+import os
+import sys
+import io
+import base64
+import json
+import time
+import math
+import random
+import struct
+import zlib
+import argparse
+import tempfile
+import threading
+import contextlib
+import importlib.util
+import http.server
+from datetime import datetime, timezone
+
+# ----------------------------------------------------
+# Офлайн-бенчмарк followings-commenting.py
+# ----------------------------------------------------
+
+# Гоняет logic_comment_followings против поддельного Instagram-клиента и локального
+# OpenAI-совместимого сервера. Все паузы идут через VirtualClock, поэтому минуты ожидания
+# между комментариями занимают доли секунды. Сеть не нужна.
+#
+#   python benchmark.py --followings 300 --posts 3 --fresh-ratio 0.3
+#   python benchmark.py --output bench.json
+#   python benchmark.py --compare bench.json  # регрессия: код выхода 1, если стало хуже
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "followings-commenting.py")
+
+
+class VirtualClock:
+    # Подменяет модуль time в скрипте. Виртуальное время идёт только в sleep() - паузах скрипта и
+    # имитации задержек Instagram и OpenAI: sleep(s) назначает срок "сейчас + s", ждёт s / speed реальных
+    # секунд и переводит часы на этот срок. Вычисления, диск и ожидание очередей виртуального времени
+    # не занимают, поэтому результат почти не зависит от скорости машины и от --speed; паузы разных потоков
+    # перекрываются, как в реальности.
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.lock = threading.Lock()
+        self._virt0 = time.time()
+        self._now = self._virt0  # Абсолютное время: ожидания считаются от time(), и шаг должен быть виден в нём
+
+    def elapsed(self):
+        return self.time() - self._virt0
+
+    def time(self):
+        with self.lock:
+            return self._now
+
+    def monotonic(self):
+        return self.elapsed()
+
+    def sleep(self, seconds):
+        seconds = max(0.0, seconds)
+        with self.lock:
+            deadline = self._now + seconds
+        time.sleep(seconds / self.speed)
+        with self.lock:
+            # Ненулевая пауза сдвигает часы хотя бы на один шаг float: иначе ожидание вроде 1e-16с
+            # (добор токена в rate_acquire) ничего не меняет, и вызывающий крутится вечно
+            if seconds > 0:
+                deadline = max(deadline, math.nextafter(self._now, math.inf))
+            self._now = max(self._now, deadline)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class ThrottledError(Exception):
+    code = 429  # Как ClientError в instagrapi
+
+
+class FakeClient:
+    # Поддельный instagrapi.Client: подписки, посты, лента, комментарии.
+    # latency - виртуальные секунды на запрос, rate_limit_prob - доля запросов, отвечающих 429.
+
+    def __init__(self, clock, base_url, followings, posts_per_user, fresh_ratio, latency, rate_limit_prob, seed):
+        self.clock = clock
+        self.base_url = base_url
+        self.followings = followings
+        self.posts_per_user = posts_per_user
+        self.fresh_ratio = fresh_ratio
+        self.latency = latency
+        self.rate_limit_prob = rate_limit_prob
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.user_id = "1"
+        self.rank_token = "bench"
+        self.calls = {}
+        self.comments = 0
+        self.lock = threading.Lock()
+        self.media_ages = {}  # pk -> часов с публикации
+
+    def _call(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            throttled = self.random.random() < self.rate_limit_prob
+        self.clock.sleep(self.latency)
+        if throttled:
+            raise ThrottledError("429 Too Many Requests")
+
+    def _media_age(self, pk):
+        # Возраст зависит только от seed и pk, чтобы прогоны в разных режимах видели одни и те же посты
+        with self.lock:
+            if pk not in self.media_ages:
+                rnd = random.Random(self.seed * 1000003 + pk)
+                fresh = rnd.random() < self.fresh_ratio
+                self.media_ages[pk] = rnd.uniform(0.5, 20) if fresh else rnd.uniform(30, 24 * 60)
+            return self.media_ages[pk]
+
+    def _image_versions(self, pk):
+        width, height = IMAGE_SIZE
+        return {"candidates": [{"url": f"{self.base_url}/img/{pk}.png", "width": width, "height": height}]}
+
+    def _raw_media(self, user_pk, n):
+        # Каждый третий пост - альбом из 3 слайдов с коротким описанием
+        pk = user_pk * 1000 + n
+        media = {
+            "pk": pk,
+            "id": f"{pk}_{user_pk}",
+            "code": f"B{pk}",
+            "taken_at": int(self.clock.time() - self._media_age(pk) * 3600),
+            "media_type": 1 if n % 3 else 8,
+            "user": {"pk": str(user_pk), "username": f"user{user_pk}"},
+            "caption": {"text": f"Caption of post {pk} that is long enough to be commented on." if n % 3 else "Album"},
+            "like_count": 0,
+            "product_type": "feed" if n % 3 else "carousel_container",
+        }
+        if n % 3:
+            media["image_versions2"] = self._image_versions(pk)
+        else:
+            media["carousel_media"] = [
+                {"pk": str(pk * 10 + i), "id": f"{pk * 10 + i}_{user_pk}", "media_type": 1,
+                 "image_versions2": self._image_versions(pk * 10 + i)}
+                for i in range(3)
+            ]
+        return media
+
+    def user_following_v1_chunk(self, user_id, max_amount=0, max_id=""):
+        from instagrapi.types import UserShort
+        self._call("user_following")
+        start = int(max_id or 0)
+        end = min(self.followings, start + (max_amount or self.followings))
+        users = [UserShort(pk=str(i), username=f"user{i}") for i in range(start + 1, end + 1)]
+        return users, (str(end) if end < self.followings else None)
+
+    def private_request(self, endpoint, params=None):
+        # Только friendships/{id}/following/ с order=date_followed_latest: последние подписки (большие pk) сверху
+        assert endpoint.startswith("friendships/") and params.get("order") == "date_followed_latest", endpoint
+        self._call("user_following")
+        start = int(params.get("max_id") or 0)
+        end = min(self.followings, start + int(params.get("count") or self.followings))
+        users = [{"pk": str(self.followings - i), "username": f"user{self.followings - i}",
+                  "full_name": "", "profile_pic_url": f"{self.base_url}/img/0.png"} for i in range(start, end)]
+        return {"users": users, "next_max_id": str(end) if end < self.followings else None}
+
+    def user_id_from_username(self, username):
+        self._call("user_id_from_username")
+        return username[len("user"):]
+
+    def user_info(self, user_id):
+        from instagrapi.types import UserShort
+        self._call("user_info")
+        return UserShort(pk=str(user_id), username=f"user{user_id}")
+
+    def user_medias(self, user_id, amount=0):
+        from instagrapi.extractors import extract_media_v1
+        self._call("user_medias")
+        return [extract_media_v1(self._raw_media(int(user_id), n)) for n in range(amount or self.posts_per_user)]
+
+    def get_timeline_feed(self, reason="pull_to_refresh", max_id=None):
+        self._call("get_timeline_feed")
+        page = int(max_id or 0)
+        items = []
+        for _ in range(10):
+            user_pk = self.random.randint(1, self.followings)
+            items.append({"media_or_ad": self._raw_media(user_pk, self.random.randrange(self.posts_per_user))})
+        return {"feed_items": items, "more_available": True, "next_max_id": str(page + 1)}
+
+    def media_comment(self, media_id, text):
+        self._call("media_comment")
+        with self.lock:
+            self.comments += 1
+
+    def media_like(self, media_id):
+        self._call("media_like")
+        return True
+
+
+IMAGE_SIZE = (1080, 1350)  # Как у обычной миниатюры Instagram
+
+
+def image_size(data):
+    # Размер PNG или JPEG по заголовку, без Pillow
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return struct.unpack(">II", data[16:24])
+    i = 2
+    while i < len(data):
+        marker, length = data[i + 1], struct.unpack(">H", data[i + 2:i + 4])[0]
+        if marker in (0xC0, 0xC1, 0xC2):
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height
+        i += 2 + length
+    return IMAGE_SIZE
+
+
+def vision_tokens(width, height, detail):
+    # Цена картинки у gpt-4o-mini: 2833 за "low", иначе 2833 + 5667 за каждый тайл 512px
+    if detail == "low":
+        return 2833
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    if min(width, height) > 768:
+        scale = 768 / min(width, height)
+        width, height = width * scale, height * scale
+    return 2833 + 5667 * (-(-int(width) // 512)) * (-(-int(height) // 512))
+
+
+def make_png(seed, width=IMAGE_SIZE[0], height=IMAGE_SIZE[1], grid=8):
+    # Случайная сетка grid x grid, растянутая до width x height: у каждого поста свой dHash
+    rnd = random.Random(seed)
+    cells = [[rnd.randrange(256) for _ in range(grid)] for _ in range(grid)]
+    rows = []
+    for r in range(grid):
+        row = b"\x00" + b"".join(bytes([v]) * (width // grid) for v in cells[r])
+        rows += [row] * (height // grid)
+    raw = b"".join(rows)
+    width, height = width // grid * grid, height // grid * grid
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+
+class FakeServer(http.server.ThreadingHTTPServer):
+    # Локальный OpenAI-совместимый /v1/chat/completions, картинки /img/<pk>.png и Telegram sendMessage
+
+    daemon_threads = True
+
+    def __init__(self, clock, ai_latency, ai_error_prob, seed):
+        super().__init__(("127.0.0.1", 0), FakeHandler)
+        self.clock = clock
+        self.ai_latency = ai_latency
+        self.ai_error_prob = ai_error_prob
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"ai_requests": 0, "ai_errors": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                      "cached_tokens": 0, "image_requests": 0, "telegram_messages": 0}
+        self.recent_prompts = []  # Для имитации кеша префикса OpenAI
+
+    def cached_prefix_tokens(self, prompt):
+        # Как у OpenAI: кешируется общий префикс с недавними запросами от 1024 токенов, шагами по 128
+        with self.lock:
+            common = 0
+            for previous in self.recent_prompts:
+                n = 0
+                for a, b in zip(previous, prompt):
+                    if a != b:
+                        break
+                    n += 1
+                common = max(common, n)
+            self.recent_prompts = (self.recent_prompts + [prompt])[-16:]
+        tokens = common // 4
+        return tokens // 128 * 128 if tokens >= 1024 else 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body, content_type="application/json"):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/img/"):
+            self.server.count("image_requests")
+            pk = int(self.path[len("/img/"):].split(".")[0])
+            self._reply(200, make_png(pk), "image/png")
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if "/sendMessage" in self.path:
+            self.server.count("telegram_messages")
+            self._reply(200, {"ok": True})
+        elif self.path.endswith("/chat/completions"):
+            self._chat_completion(body)
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def _chat_completion(self, body):
+        server = self.server
+        server.count("ai_requests")
+        server.clock.sleep(server.ai_latency)
+        with server.lock:
+            failed = server.random.random() < server.ai_error_prob
+        if failed:
+            server.count("ai_errors")
+            self._reply(500, {"error": {"message": "injected failure", "type": "server_error"}})
+            return
+
+        request = json.loads(body)
+        if request.get("response_format", {}).get("type") == "json_schema":
+            content = json.dumps({"comment": "What a beautiful shot, love the mood!",
+                                  "description": "A photo.", "refused": False})
+        elif any(isinstance(m.get("content"), list) for m in request.get("messages", [])):
+            content = "A colourful photo of a city street at dusk with warm light and a calm mood."
+        else:
+            content = "What a beautiful shot, love the mood!"
+        prompt_tokens = 0
+        for message in request.get("messages", []):
+            parts = message["content"] if isinstance(message["content"], list) else [{"type": "text", "text": message["content"]}]
+            for part in parts:
+                if part["type"] == "text":
+                    prompt_tokens += len(part["text"]) // 4
+                else:
+                    url = part["image_url"]["url"]
+                    size = image_size(base64.b64decode(url.split(",", 1)[1])) if url.startswith("data:") else IMAGE_SIZE
+                    prompt_tokens += vision_tokens(*size, part["image_url"].get("detail", "auto"))
+        completion_tokens = len(content) // 4
+        cached_tokens = min(prompt_tokens, server.cached_prefix_tokens(json.dumps(request.get("messages", []))))
+        server.count("prompt_tokens", prompt_tokens)
+        server.count("cached_tokens", cached_tokens)
+        server.count("completion_tokens", completion_tokens)
+        self._reply(200, {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o-mini"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content, "refusal": None}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens,
+                      "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+        })
+
+
+def load_script(workdir):
+    # Скрипт пишет logs/ и Sessions/ относительно текущей папки, поэтому грузим его уже из workdir
+    os.chdir(workdir)
+    spec = importlib.util.spec_from_file_location("followings_commenting", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_benchmark(args):
+    clock = VirtualClock(args.speed)
+    server = FakeServer(clock, args.ai_latency, args.ai_error_prob, args.seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="ig-bench-")
+    try:
+        fc = load_script(workdir)
+        fc.time = clock
+        fc.TELEGRAM_API_URL = server.url
+        fc.PIPELINE_ENABLED = args.pipeline
+        fc.DISCOVERY_SOURCE = args.discovery
+        fc.COMMENT_MODE = args.comment_mode
+        fc.SUBSCRIPTIONS_POSTS_AMOUNT = args.posts
+
+        candidates = {"count": 0}
+        select_candidates = fc.select_candidates
+        def counting_select(posts, commented_index):
+            selected = select_candidates(posts, commented_index)
+            candidates["count"] += len(selected)
+            return selected
+        fc.select_candidates = counting_select
+
+        session_path = os.path.join(fc.SESSIONS_DIR, "bench")
+        os.makedirs(session_path, exist_ok=True)
+        config = fc.configparser.ConfigParser()
+        config['Instagram'] = {'ig_username': 'bench'}
+        config['OpenAI'] = {}
+        config['Session'] = {'path': session_path}
+
+        cl = FakeClient(clock, server.url, args.followings, args.posts, args.fresh_ratio,
+                        args.ig_latency, args.rate_limit_prob, args.seed)
+        ai_client = fc.create_ai_client("bench", base_url=f"{server.url}/v1")
+
+        real_start = time.monotonic()
+        cpu_start = time.process_time()
+        virt_start = clock.elapsed()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fc.logic_comment_followings(cl, config, ai_client)
+            fc.shutdown_telegram(timeout=5)
+        wall = time.monotonic() - real_start
+        cpu = time.process_time() - cpu_start
+        virtual = clock.elapsed() - virt_start
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+
+    usage = list(fc.USAGE_BUFFER)
+    tokens = sum(e["input_tokens"] + e["output_tokens"] for e in usage)
+    ig_calls = sum(cl.calls.values())
+    comments = cl.comments
+    hours = virtual / 3600 if virtual else 0
+    return {
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "params": vars(args).copy(),
+        "followings": args.followings,
+        "candidates": candidates["count"],
+        "comments": comments,
+        "virtual_hours": round(hours, 3),
+        "wall_seconds": round(wall, 2),
+        "cpu_seconds": round(cpu, 2),  # Реальные вычисления, в виртуальные часы не входят
+        "candidates_per_hour": round(candidates["count"] / hours, 2) if hours else 0,
+        "comments_per_hour": round(comments / hours, 2) if hours else 0,
+        "ig_calls": cl.calls,
+        "ig_calls_per_comment": round(ig_calls / comments, 2) if comments else None,
+        "ai_requests": server.stats["ai_requests"],
+        "ai_requests_per_comment": round(server.stats["ai_requests"] / comments, 2) if comments else None,
+        "tokens_per_comment": round(tokens / comments, 1) if comments else None,
+        "cached_tokens_share": round(sum(e.get("cached_tokens", 0) for e in usage) / tokens, 3) if tokens else 0,
+        "image_cache": dict(fc.IMAGE_CACHE_STATS),
+        "server": server.stats,
+        "metrics": fc.metrics_snapshot(),
+    }
+
+
+# Метрики, которые при регрессии не должны ухудшаться больше чем на --tolerance
+REGRESSION_CHECKS = {
+    "comments_per_hour": "higher",
+    "candidates_per_hour": "higher",
+    "ig_calls_per_comment": "lower",
+    "tokens_per_comment": "lower",
+}
+
+
+def compare(result, baseline, tolerance):
+    failures = []
+    for key, better in REGRESSION_CHECKS.items():
+        new, old = result.get(key), baseline.get(key)
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        if (better == "higher" and change < -tolerance) or (better == "lower" and change > tolerance):
+            failures.append(f"{key}: {old} -> {new} ({change:+.1%})")
+    return failures
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк комментирования подписок")
+    parser.add_argument("--followings", type=int, default=200)
+    parser.add_argument("--posts", type=int, default=3, help="Постов на пользователя (SUBSCRIPTIONS_POSTS_AMOUNT)")
+    parser.add_argument("--fresh-ratio", type=float, default=0.2, help="Доля постов моложе POST_CUTOFF_HOURS")
+    parser.add_argument("--ig-latency", type=float, default=0.8, help="Виртуальных секунд на запрос к Instagram")
+    parser.add_argument("--ai-latency", type=float, default=2.0, help="Виртуальных секунд на запрос к OpenAI")
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0, help="Доля запросов к Instagram с 429")
+    parser.add_argument("--ai-error-prob", type=float, default=0.0, help="Доля запросов к OpenAI с 500")
+    parser.add_argument("--discovery", choices=["per_user", "timeline"], default="per_user")
+    parser.add_argument("--comment-mode", choices=["two_step", "single_call"], default="two_step")
+    parser.add_argument("--sequential", dest="pipeline", action="store_false", help="Без конвейера")
+    parser.add_argument("--speed", type=float, default=2000, help="Во сколько раз паузы короче виртуальных")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Сохранить результат в JSON")
+    parser.add_argument("--compare", help="JSON прошлого прогона для проверки регрессии")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    result = run_benchmark(args)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        baseline_speed = baseline.get("params", {}).get("speed")
+        if baseline_speed != args.speed:
+            print(f"[REGRESSION] Прогоны с разным --speed ({baseline_speed} и {args.speed}) не сравниваются")
+            sys.exit(2)
+        failures = compare(result, baseline, args.tolerance)
+        if failures:
+            print("[REGRESSION]\n" + "\n".join(failures))
+            sys.exit(1)
+        print("[REGRESSION] OK")
+
+
+if __name__ == "__main__":
+    main()
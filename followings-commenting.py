@@ -1,16 +1,41 @@
 import os
+import sys
 import time
 import random
+import math
 import json
 import logging
 import configparser
+import sqlite3
+import dbm
+import threading
+import _thread
+import signal
+import shutil
+import argparse
+import multiprocessing
+import io
+import base64
+import queue as queue_mod
+import heapq
+import asyncio
+import contextlib
+import http.server
+from urllib.parse import parse_qs
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from instagrapi import Client
-from instagrapi.exceptions import PleaseWaitFewMinutes
-from openai import OpenAI
 from filelock import FileLock
-from pydantic_core import Url
+
+try:
+    import tiktoken  # Необязательно: точный подсчёт токенов при обрезке описаний постов
+except ImportError:
+    tiktoken = None
+
+try:
+    from PIL import Image  # Необязательно: уменьшение миниатюр и перцептивный хеш для кеша описаний
+except ImportError:
+    Image = None
 
 # ----------------------------------------------------
 # 1. ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ И ПАРАМЕТРЫ
@@ -20,23 +45,105 @@ SESSIONS_DIR = "Sessions"
 LOGS_DIR = "logs"
 
 # Telegram
-TELEGRAM_BOT_TOKEN = "" #Enter your Telegram Bot ID to send notification on behalf of
-TELEGRAM_CHAT_ID = #Enter Teelgram Chat ID where you want notifications
+TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "") #Enter your Telegram Bot ID to send notification on behalf of
+TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID", "") #Enter Teelgram Chat ID where you want notifications
+TELEGRAM_API_URL = "https://api.telegram.org"
+TELEGRAM_QUEUE_SIZE = 200  # Сообщения сверх очереди отбрасываются, основной цикл никогда не ждёт Telegram
+TELEGRAM_ERROR_DIGEST_SECONDS = 30  # Ошибки за это окно отправляются одним сообщением
+TELEGRAM_MAX_RETRIES = 5
 
 # OpenAI
-OPENAI_API_KEY = "" #Enter your OpenAI Key
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "") #Enter your OpenAI Key
+
+# Запуск без терминала: сессия и данные для входа из переменных окружения
+IG_SESSION = os.environ.get("IG_SESSION", "")  # Имя сессии в Sessions/ (то же, что --session)
+IG_LOGIN = os.environ.get("IG_LOGIN", "")  # Логин и пароль для --new-session без вопросов
+IG_PASSWORD = os.environ.get("IG_PASSWORD", "")
+SESSION_TRUST_MINUTES = 30  # Сессия, проверенная недавно, используется без запроса к Instagram
 
 # Интервалы и лимиты
-SLEEP_INTERVALS = [5, 10, 20, 60, 120, 300]  # При 429
+RATE_LIMITS = {  # Token bucket на каждый тип запроса к Instagram: (запросов в минуту, запас)
+    "login": (1, 1),
+    "following": (6, 3),
+    "user_info": (30, 5),
+    "medias": (20, 5),
+    "comment": (2, 1),
+    "like": (4, 2),
+    "timeline": (6, 2),
+}
+RATE_BACKOFF_BASE = 60  # Первая пауза (сек) после 429, дальше удваивается до RATE_BACKOFF_MAX
+RATE_BACKOFF_MAX = 3600
 RANDOM_DELAY_MIN_BETWEEN_USERS = 1
 RANDOM_DELAY_MAX_BETWEEN_USERS = 2
 RANDOM_DELAY_MIN_BETWEEN_COMMENTS = 180
 RANDOM_DELAY_MAX_BETWEEN_COMMENTS = 300
-RATE_LIMIT_SLEEP = 3 * 3600
 POST_CUTOFF_HOURS = 24  # Возраст постов
 SUBSCRIPTIONS_POSTS_AMOUNT = 3  # Кол-во постов для обработки
 POST_TYPES_FOR_COMMENTING = [1, 2, 8]  # Типы постов (фото, видео, альбом)
-THRESHOLD_LENGTH_FOR_COMMENTING = 30  # Мин. длина описания
+THRESHOLD_LENGTH_FOR_COMMENTING = 30  # Мин. длина описания для постов без изображения
+COMMENT_MODE = "two_step"  # "two_step" - описание + комментарий, "single_call" - один vision-запрос со структурированным ответом
+DISCOVERY_SOURCE = "per_user"  # "per_user" - user_medias по каждой подписке, "timeline" - лента подписок (при ошибке - per_user)
+TIMELINE_MAX_PAGES = 20  # Страниц ленты за проход
+PIPELINE_ENABLED = True  # Поиск постов и генерация комментариев идут в фоне, пока основной поток ждёт между комментариями
+PIPELINE_PREFETCH_USERS = 5  # Сколько пользователей стадия поиска может опережать публикацию
+PIPELINE_READY_COMMENTS = 3  # Сколько готовых комментариев может ждать публикации
+IMAGE_CACHE_MAX_ENTRIES = 5000  # Размер кеша описаний изображений (LRU)
+IMAGE_CACHE_MAX_DISTANCE = 4  # Макс. расстояние Хэмминга между dHash, при котором картинки считаются одинаковыми
+MEDIA_CACHE_TTL = 600  # Сколько секунд посты пользователя из user_medias годятся для всех сессий на машине, 0 - без кеша
+MEDIA_CACHE_LOCK_TIMEOUT = 120  # Сколько ждать процесс, который уже загружает того же пользователя
+MEDIA_CACHE_LOCK_STRIPES = 64  # Файлов блокировок на весь кеш (блокировка по pk % N)
+IMAGE_MAX_SIDE = 512  # Миниатюра уменьшается до этого размера по большей стороне перед отправкой в OpenAI
+IMAGE_DETAIL = "low"  # Детализация для vision: "low" - фиксированная цена, "high"/"auto" - по тайлам 512px
+IMAGE_JPEG_QUALITY = 85
+IMAGE_PREPROCESS_WORKERS = 4  # Потоков для загрузки и уменьшения миниатюр
+CAROUSEL_MAX_RESOURCES = 6  # Сколько слайдов альбома описывать, не больше
+DESCRIBE_WORKERS = 4  # Одновременно описываемых слайдов одного альбома
+POST_TOKEN_BUDGET = 12000  # Токенов на описание одного поста (ограничивает число слайдов)
+POST_DESCRIBE_TIMEOUT = 60  # Секунд на описание всех слайдов поста, недоописанные отбрасываются
+OPENAI_MAX_IN_FLIGHT = 4  # Одновременных запросов к OpenAI из одного процесса
+OPENAI_REQUEST_TIMEOUT = 60  # Дедлайн (сек) на один запрос к OpenAI
+OPENAI_MAX_RETRIES = 3  # Повторы только при 429, 5xx, обрыве соединения и таймауте
+OPENAI_RETRY_BASE = 2  # Первая пауза (сек) перед повтором, дальше удваивается
+CAPTION_TOKEN_BUDGET = 300  # Описание поста длиннее этого числа токенов обрезается перед отправкой в OpenAI
+FOLLOWINGS_PAGE_SIZE = 200  # Подписок на страницу при синхронизации
+FOLLOWINGS_FULL_SYNC_HOURS = 24  # Как часто полностью сверять подписки (удалять отписки), в фоне
+SCHEDULER_ENABLED = True  # Проверять в первую очередь тех, кто вероятнее всего уже выложил новый пост
+SCHEDULER_MIN_RECHECK_MINUTES = 60  # Не проверять пользователя чаще
+SCHEDULER_MAX_SKIP_HOURS = POST_CUTOFF_HOURS / 2  # Но и не пропускать дольше, чтобы не упустить пост
+SCHEDULER_EMA_ALPHA = 0.3  # Вес нового наблюдения в средней частоте постов
+SCHEDULER_DORMANT_DAYS = 30  # Без постов дольше - аккаунт считается спящим
+SCHEDULER_DORMANT_TTL_HOURS = 72  # Спящий аккаунт перепроверяется не чаще
+USER_PK_CACHE_TTL_HOURS = 7 * 24  # Как часто сверять имя пользователя по его pk (имя может смениться, pk - нет)
+USER_FETCH_MAX_ATTEMPTS = 3  # Попыток получить посты пользователя (с пересозданием сессии между ними)
+SUPERVISOR_OPENAI_CONCURRENCY = 4  # Одновременных обращений к OpenAI на все аккаунты супервизора
+SUPERVISOR_COST_BUDGET = 0.0  # Бюджет OpenAI ($) на запуск супервизора, 0 - без ограничения
+SUPERVISOR_RESTART_DELAY = 60  # Пауза (сек) перед перезапуском упавшего воркера, удваивается при частых падениях
+SUPERVISOR_STATUS_INTERVAL = 60  # Как часто (сек) печатать сводку по аккаунтам
+SUPERVISOR_STOP_TIMEOUT = 30  # Сколько ждать, пока воркеры сохранят учёт и завершатся сами, потом terminate
+USAGE_FLUSH_INTERVAL = 60  # Как часто (сек) сбрасывать учёт токенов OpenAI в журнал и ig_login.ini
+COMMENTED_LOG = "commented.txt"  # Журнал прокомментированных постов (в папке сессии)
+COMMENTED_INDEX_BACKEND = "memory"  # "memory" - set в памяти, "dbm" - хеш-индекс на диске для больших историй
+OUTBOX_MAX_ATTEMPTS = 5  # Попыток опубликовать (или лайкнуть) пост из журнала, потом пост бросается
+OUTBOX_RETRY_MINUTES = 15  # Пауза перед повтором, удваивается с каждой попыткой
+OUTBOX_MAX_AGE_HOURS = POST_CUTOFF_HOURS * 2  # Недоопубликованные посты старше этого не комментируются
+JOURNAL_RETENTION_DAYS = 7  # Сколько хранить завершённые записи журнала
+DAEMON_SETTINGS_FILE = "settings.json"  # Параметры для режима демона: {"ИМЯ": значение}, применяются без перезапуска
+DAEMON_SETTINGS_POLL = 5  # Как часто (сек) проверять, не изменился ли файл параметров
+DAEMON_CONTROL_PORT = 8790  # Порт API управления демоном на 127.0.0.1
+DAEMON_PASS_INTERVAL = 15  # Пауза (мин) между проходами по подпискам в режиме демона
+DAEMON_RELOADABLE = (  # Что можно менять в DAEMON_SETTINGS_FILE на ходу
+    "RANDOM_DELAY_MIN_BETWEEN_USERS", "RANDOM_DELAY_MAX_BETWEEN_USERS",
+    "RANDOM_DELAY_MIN_BETWEEN_COMMENTS", "RANDOM_DELAY_MAX_BETWEEN_COMMENTS",
+    "POST_CUTOFF_HOURS", "SUBSCRIPTIONS_POSTS_AMOUNT", "POST_TYPES_FOR_COMMENTING", "THRESHOLD_LENGTH_FOR_COMMENTING",
+    "COMMENT_MODE", "DISCOVERY_SOURCE", "TIMELINE_MAX_PAGES", "SCHEDULER_ENABLED", "SCHEDULER_MIN_RECHECK_MINUTES",
+    "SCHEDULER_MAX_SKIP_HOURS", "IMAGE_DETAIL", "CAROUSEL_MAX_RESOURCES", "POST_TOKEN_BUDGET", "POST_DESCRIBE_TIMEOUT",
+    "CAPTION_TOKEN_BUDGET", "PROMPT_DESCRIBE_IMAGE", "PROMPT_COMMENT", "PROMPT_COMMENT_MULTIMODAL",
+    "OUTBOX_MAX_ATTEMPTS", "OUTBOX_RETRY_MINUTES", "OUTBOX_MAX_AGE_HOURS", "MEDIA_CACHE_TTL", "DAEMON_PASS_INTERVAL",
+)
+METRICS_HTTP_PORT = 0  # Порт для метрик в формате Prometheus на 127.0.0.1, 0 - выключено
+METRICS_SNAPSHOT_INTERVAL = 60  # Как часто (сек) дописывать снимок метрик в {session}/metrics.jsonl, 0 - выключено
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)  # Границы гистограмм длительности (сек)
+PROFILER_SAMPLE_INTERVAL = 0.0  # Сэмплирующий профайлер основного цикла: период (сек), 0 - выключен
 
 # ----------------------------------------------------
 # 2. ЛОГИРОВАНИЕ
@@ -60,28 +167,273 @@ error_logger.addHandler(error_handler)
 error_logger.setLevel(logging.ERROR)
 
 # ----------------------------------------------------
-# 3. ФУНКЦИЯ ОТПРАВКИ В TELEGRAM
+# 3. МЕТРИКИ
 # ----------------------------------------------------
 
-def send_telegram_message(msg: str):
+# Счётчики и гистограммы длительности по стадиям: запросы к Instagram и 429, OpenAI, Telegram,
+# паузы, пропуски постов по причинам, токены, стоимость, комментарии. Отдаются в формате Prometheus
+# на 127.0.0.1:METRICS_HTTP_PORT и раз в METRICS_SNAPSHOT_INTERVAL секунд пишутся в {session}/metrics.jsonl.
+
+METRICS_LOCK = threading.Lock()
+METRICS_COUNTERS = {}    # (имя, метки) -> значение
+METRICS_HISTOGRAMS = {}  # (имя, метки) -> {"buckets": [...], "sum", "count"}
+
+def _metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def metric_inc(name, value=1, **labels):
+    key = _metric_key(name, labels)
+    with METRICS_LOCK:
+        METRICS_COUNTERS[key] = METRICS_COUNTERS.get(key, 0) + value
+
+def metric_observe(name, seconds, **labels):
+    key = _metric_key(name, labels)
+    with METRICS_LOCK:
+        hist = METRICS_HISTOGRAMS.get(key)
+        if hist is None:
+            hist = {"buckets": [0] * len(METRICS_LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+            METRICS_HISTOGRAMS[key] = hist
+        for i, bound in enumerate(METRICS_LATENCY_BUCKETS):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+                break
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+@contextlib.contextmanager
+def metric_timer(stage):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        metric_observe("stage_seconds", time.monotonic() - start, stage=stage)
+
+def _metric_name(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+def metrics_snapshot():
+    # Гистограммы в снимке - без разбивки по корзинам, только количество, сумма и среднее
+    with METRICS_LOCK:
+        counters = {_metric_name(n, l): v for (n, l), v in METRICS_COUNTERS.items()}
+        histograms = {
+            _metric_name(n, l): {"count": h["count"], "sum": round(h["sum"], 3),
+                                 "avg": round(h["sum"] / h["count"], 3) if h["count"] else 0}
+            for (n, l), h in METRICS_HISTOGRAMS.items()
+        }
+    return {"ts": int(time.time()), "counters": counters, "histograms": histograms}
+
+def metrics_prometheus():
+    lines = []
+    with METRICS_LOCK:
+        for (name, labels), value in sorted(METRICS_COUNTERS.items()):
+            lines.append(f"igc_{_metric_name(name, labels)} {value}")
+        for (name, labels), hist in sorted(METRICS_HISTOGRAMS.items()):
+            cumulative = 0
+            for bound, n in zip(METRICS_LATENCY_BUCKETS, hist["buckets"]):
+                cumulative += n
+                lines.append(f"igc_{_metric_name(name + '_bucket', labels + (('le', bound),))} {cumulative}")
+            lines.append(f"igc_{_metric_name(name + '_bucket', labels + (('le', '+Inf'),))} {hist['count']}")
+            lines.append(f"igc_{_metric_name(name + '_sum', labels)} {hist['sum']}")
+            lines.append(f"igc_{_metric_name(name + '_count', labels)} {hist['count']}")
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_metrics_exporter(port):
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {"chat_id": TELEGRAM_CHAT_ID, "text": msg}
-        r = requests.post(url, data=data, timeout=20)
-        if r.status_code != 200:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    except OSError as e:
+        log_error(f"[METRICS] Не удалось открыть порт {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"[METRICS] Метрики доступны на http://127.0.0.1:{port}/metrics")
+    return server
+
+def write_metrics_snapshot(session_path):
+    with open(os.path.join(session_path, 'metrics.jsonl'), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(metrics_snapshot(), ensure_ascii=False) + "\n")
+
+def start_metrics_snapshots(session_path):
+    def loop():
+        while True:
+            time.sleep(METRICS_SNAPSHOT_INTERVAL)
+            try:
+                write_metrics_snapshot(session_path)
+            except Exception as e:
+                error_logger.error(f"[METRICS] Ошибка записи снимка метрик: {e}")
+
+    threading.Thread(target=loop, name="metrics-snapshots", daemon=True).start()
+
+# Профайлер раз в PROFILER_SAMPLE_INTERVAL секунд снимает стеки всех потоков (sys._current_frames)
+# и по завершении пишет их в logs/profile_*.txt в формате collapsed stacks (flamegraph.pl, speedscope).
+
+@contextlib.contextmanager
+def sampling_profiler(name):
+    if PROFILER_SAMPLE_INTERVAL <= 0:
+        yield
+        return
+
+    stacks = {}
+    stop = threading.Event()
+    own_ident = []
+
+    def sample():
+        own_ident.append(threading.get_ident())
+        names = {}
+        while not stop.is_set():
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for ident, frame in sys._current_frames().items():
+                if ident in own_ident:
+                    continue
+                parts = []
+                while frame is not None:
+                    code = frame.f_code
+                    parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = ";".join([names.get(ident, str(ident))] + parts[::-1])
+                stacks[key] = stacks.get(key, 0) + 1
+            stop.wait(PROFILER_SAMPLE_INTERVAL)
+
+    sampler = threading.Thread(target=sample, name="profiler", daemon=True)
+    sampler.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        sampler.join()
+        path = os.path.join(LOGS_DIR, f"profile_{name}_{datetime.now():%Y%m%d_%H%M%S}.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            for key, count in sorted(stacks.items(), key=lambda kv: -kv[1]):
+                f.write(f"{key} {count}\n")
+        print(f"[PROFILER] {sum(stacks.values())} сэмплов сохранено в {path}")
+
+# ----------------------------------------------------
+# 4. ФУНКЦИЯ ОТПРАВКИ В TELEGRAM
+# ----------------------------------------------------
+
+# Сообщения отправляет фоновый поток через общую requests.Session.
+# Ошибки копятся TELEGRAM_ERROR_DIGEST_SECONDS секунд и уходят одним дайджестом,
+# при 429/5xx/сетевых ошибках отправка повторяется с экспоненциальной паузой.
+
+TELEGRAM_MAX_LENGTH = 4096
+_telegram_queue = queue_mod.Queue(maxsize=TELEGRAM_QUEUE_SIZE)
+_telegram_session = requests.Session()
+_telegram_thread = None
+_telegram_start_lock = threading.Lock()
+
+def _telegram_deliver(msg: str):
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    data = {"chat_id": TELEGRAM_CHAT_ID, "text": msg[:TELEGRAM_MAX_LENGTH]}
+    for attempt in range(TELEGRAM_MAX_RETRIES):
+        delay = min(2 ** attempt, 60) + random.uniform(0, 1)
+        try:
+            with metric_timer("telegram"):
+                r = _telegram_session.post(url, data=data, timeout=20)
+            if r.status_code == 200:
+                print("[TELEGRAM] Message sent successfully.")
+                metric_inc("telegram_messages_total", result="sent")
+                return True
             error_logger.error(f"[TELEGRAM] status={r.status_code}, text={r.text}")
-        else:
-            print("[TELEGRAM] Message sent successfully.")
-    except Exception as e:
-        error_logger.error(f"[TELEGRAM] {e}")
+            if r.status_code == 429:
+                try:
+                    delay = float(r.json()["parameters"]["retry_after"])
+                except Exception:
+                    pass
+            elif r.status_code < 500:
+                metric_inc("telegram_messages_total", result="failed")
+                return False
+        except Exception as e:
+            error_logger.error(f"[TELEGRAM] {e}")
+        time.sleep(delay)
+    metric_inc("telegram_messages_total", result="failed")
+    return False
+
+def _telegram_error_digest(errors):
+    if len(errors) == 1:
+        return f"ERROR: {errors[0]}"
+    lines = [f"ERRORS x{len(errors)} за {TELEGRAM_ERROR_DIGEST_SECONDS}с:"]
+    lines += [f"- {e}" for e in errors]
+    return "\n".join(lines)
+
+def _telegram_worker():
+    errors = []
+    first_error_ts = None
+    while True:
+        timeout = None
+        if errors:
+            timeout = max(0.0, first_error_ts + TELEGRAM_ERROR_DIGEST_SECONDS - time.time())
+        try:
+            item = _telegram_queue.get(timeout=timeout)
+        except queue_mod.Empty:
+            item = ("flush", "")
+
+        if item is None:
+            if errors:
+                _telegram_deliver(_telegram_error_digest(errors))
+            return
+
+        kind, text = item
+        if kind == "error":
+            errors.append(text)
+            if first_error_ts is None:
+                first_error_ts = time.time()
+        elif kind == "message":
+            _telegram_deliver(text)
+
+        if errors and time.time() >= first_error_ts + TELEGRAM_ERROR_DIGEST_SECONDS:
+            _telegram_deliver(_telegram_error_digest(errors))
+            errors = []
+            first_error_ts = None
+
+def _telegram_enqueue(kind, text):
+    global _telegram_thread
+    with _telegram_start_lock:
+        if _telegram_thread is None:
+            _telegram_thread = threading.Thread(target=_telegram_worker, name="telegram", daemon=True)
+            _telegram_thread.start()
+    try:
+        _telegram_queue.put_nowait((kind, text))
+    except queue_mod.Full:
+        metric_inc("telegram_messages_total", result="dropped")
+        error_logger.error(f"[TELEGRAM] Очередь переполнена, сообщение отброшено: {text[:200]}")
+
+def send_telegram_message(msg: str):
+    _telegram_enqueue("message", msg)
+
+def shutdown_telegram(timeout=30):
+    # Досылаем накопленное перед выходом, но не дольше timeout секунд
+    if _telegram_thread is None:
+        return
+    try:
+        _telegram_queue.put(None, timeout=timeout)
+    except queue_mod.Full:
+        return
+    _telegram_thread.join(timeout)
 
 def log_error(msg: str):
     error_logger.error(msg)
     print("[ERROR]", msg)
-    send_telegram_message(f"ERROR: {msg}")
+    _telegram_enqueue("error", msg)
 
 # ----------------------------------------------------
-# 4. УТИЛИТЫ ДЛЯ JSON, CONFIG
+# 5. УТИЛИТЫ ДЛЯ JSON, CONFIG
 # ----------------------------------------------------
 
 def ensure_json_file(path):
@@ -101,42 +453,566 @@ def write_json_list(path, data_list):
     with open(path, 'w', encoding='utf-8') as f:
         json.dump(data_list, f, ensure_ascii=False, indent=2)
 
+# ig_login.ini пишут основной поток, поиск конвейера (checked_at при пересоздании сессии) и сброс учёта
+# OpenAI. Все они работают с одним объектом на сессию из load_config и меняют его под CONFIG_LOCK,
+# иначе каждый записал бы свою копию поверх чужих изменений.
+
+CONFIG_LOCK = threading.RLock()
+_configs = {}  # abspath сессии -> ConfigParser
+
 def load_config(session_path):
-    config_file = os.path.join(session_path, 'ig_login.ini')
-    if not os.path.exists(config_file):
-        raise FileNotFoundError(f"Config file not found: {config_file}")
-    c = configparser.ConfigParser()
-    with open(config_file, 'r', encoding='utf-8') as f:
-        c.read_file(f)
-    for section in ['Instagram', 'OpenAI', 'Session']:
-        if section not in c:
-            raise KeyError(f"Missing section [{section}] in config.")
-    return c
+    key = os.path.abspath(session_path)
+    with CONFIG_LOCK:
+        if key in _configs:
+            return _configs[key]
+        config_file = os.path.join(session_path, 'ig_login.ini')
+        if not os.path.exists(config_file):
+            raise FileNotFoundError(f"Config file not found: {config_file}")
+        c = configparser.ConfigParser()
+        with open(config_file, 'r', encoding='utf-8') as f:
+            c.read_file(f)
+        for section in ['Instagram', 'OpenAI', 'Session']:
+            if section not in c:
+                raise KeyError(f"Missing section [{section}] in config.")
+        _configs[key] = c
+        return c
 
 def save_config(session_path, config):
+    # Пишем во временный файл (свой у каждого потока) и подменяем, чтобы сбой на середине записи
+    # не испортил ig_login.ini
     config_file = os.path.join(session_path, 'ig_login.ini')
-    with open(config_file, 'w', encoding='utf-8') as f:
-        config.write(f)
+    tmp_file = f"{config_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with CONFIG_LOCK:
+        _configs[os.path.abspath(session_path)] = config
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            config.write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, config_file)
 
 # ----------------------------------------------------
-# 5. СОЗДАНИЕ / ВЫБОР СЕССИИ
+# 6. ОЧЕРЕДЬ ПОДПИСОК (SQLite)
 # ----------------------------------------------------
 
-def create_new_session():
-    session_name = input("Введите имя новой сессии: ")
+# Очередь хранится в logs/{username}_followings.db: позиция pos задаёт порядок обхода,
+# перенос пользователя в конец - один UPDATE по индексу, каждая операция - отдельная транзакция.
+
+def open_followings_queue(username):
+    db_path = os.path.join(LOGS_DIR, f"{username}_followings.db")
+    # Соединение используется и из фонового потока поиска конвейера, но никогда одновременно
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS followings (username TEXT PRIMARY KEY, pos INTEGER NOT NULL)")
+        columns = {r[1] for r in conn.execute("PRAGMA table_info(followings)")}
+        if "pk" not in columns:
+            conn.execute("ALTER TABLE followings ADD COLUMN pk TEXT")
+            conn.execute("ALTER TABLE followings ADD COLUMN pk_updated_at INTEGER NOT NULL DEFAULT 0")
+        if "seen_sync" not in columns:
+            conn.execute("ALTER TABLE followings ADD COLUMN seen_sync INTEGER NOT NULL DEFAULT 0")
+        if "last_checked" not in columns:
+            conn.execute("ALTER TABLE followings ADD COLUMN last_post_ts REAL NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE followings ADD COLUMN avg_interval REAL NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE followings ADD COLUMN last_checked INTEGER NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE followings ADD COLUMN dormant_until INTEGER NOT NULL DEFAULT 0")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_followings_pos ON followings(pos)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_followings_pk ON followings(pk)")
+
+    # Миграция со старого текстового списка
+    legacy_file = os.path.join(LOGS_DIR, f"{username}_followings.txt")
+    if os.path.exists(legacy_file) and queue_size(conn) == 0:
+        with open(legacy_file, 'r') as f:
+            users = [x.strip() for x in f if x.strip()]
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO followings (username, pos) VALUES (?, ?)",
+                ((u, i) for i, u in enumerate(users))
+            )
+        os.replace(legacy_file, legacy_file + ".migrated")
+        print(f"[Очередь] Перенесено {len(users)} подписок из {legacy_file}.")
+    return conn
+
+def queue_size(conn):
+    return conn.execute("SELECT COUNT(*) FROM followings").fetchone()[0]
+
+def queue_snapshot(conn):
+    return [r[0] for r in conn.execute("SELECT username FROM followings ORDER BY pos")]
+
+def queue_merge(conn, users):
+    # users - пары (username, pk) из user_following.
+    # Новые подписки встают в начало очереди, уже известные остаются на своих местах,
+    # переименованные (тот же pk под новым именем) сохраняют свою позицию.
+    users = list(dict(users).items())
+    now_ts = int(time.time())
+    min_pos = conn.execute("SELECT COALESCE(MIN(pos), 0) FROM followings").fetchone()[0]
+    start = min_pos - len(users)
+    with conn:
+        before = conn.total_changes
+        conn.executemany(
+            "UPDATE OR IGNORE followings SET username = ? WHERE pk = ? AND username <> ?",
+            ((u, pk, u) for u, pk in users)
+        )
+        renamed = conn.total_changes - before
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO followings (username, pos, pk, pk_updated_at) VALUES (?, ?, ?, ?)",
+            ((u, start + i, pk, now_ts) for i, (u, pk) in enumerate(users))
+        )
+        added = conn.total_changes - before
+        conn.executemany(
+            "UPDATE followings SET pk = ?, pk_updated_at = ? WHERE username = ?",
+            ((pk, now_ts, u) for u, pk in users)
+        )
+    if renamed:
+        print(f"[Очередь] Переименовано подписок: {renamed}.")
+    return added
+
+def resolve_user_pk(cl, conn, username):
+    # Возвращает (pk, текущее имя). pk - постоянный ключ пользователя. Раз в USER_PK_CACHE_TTL_HOURS
+    # по pk сверяем имя (user_info), по имени pk ищется только для старых записей, где его ещё нет
+    row = conn.execute("SELECT pk, pk_updated_at FROM followings WHERE username = ?", (username,)).fetchone()
+    if row and row[0]:
+        pk = row[0]
+        if time.time() - row[1] < USER_PK_CACHE_TTL_HOURS * 3600:
+            return pk, username
+        info = rate_limited_call("user_info", cl.user_info, pk)
+        with conn:
+            cur = conn.execute(
+                "UPDATE OR IGNORE followings SET username = ?, pk_updated_at = ? WHERE pk = ?",
+                (info.username, int(time.time()), pk)
+            )
+            if cur.rowcount == 0:
+                # Новое имя уже в очереди (его добавила синхронизация) - старая запись лишняя
+                conn.execute("DELETE FROM followings WHERE username = ?", (username,))
+                conn.execute(
+                    "UPDATE followings SET pk = ?, pk_updated_at = ? WHERE username = ?",
+                    (pk, int(time.time()), info.username)
+                )
+        if info.username != username:
+            print(f"[Очередь] {username} переименован в {info.username}.")
+        return pk, info.username
+    pk = str(rate_limited_call("user_info", cl.user_id_from_username, username))
+    with conn:
+        conn.execute(
+            "UPDATE followings SET pk = ?, pk_updated_at = ? WHERE username = ?",
+            (pk, int(time.time()), username)
+        )
+    return pk, username
+
+# Планировщик: для каждого пользователя хранится время последнего поста, средний интервал между
+# постами (EMA по наблюдённым taken_at) и время последней проверки. Проход строится кучей по
+# ожидаемому времени следующего поста; кто ещё "не должен был" выложить пост - пропускается,
+# спящие аккаунты попадают в негативный кеш на SCHEDULER_DORMANT_TTL_HOURS.
+
+def queue_record_activity(conn, username, taken_ats):
+    row = conn.execute("SELECT last_post_ts, avg_interval FROM followings WHERE username = ?", (username,)).fetchone()
+    if row is None:
+        return
+    now_ts = time.time()
+    last_post_ts, avg_interval = row
+
+    new_posts = sorted(t for t in taken_ats if t > last_post_ts)
+    series = ([last_post_ts] if last_post_ts else []) + new_posts
+    gaps = [b - a for a, b in zip(series, series[1:]) if b > a]
+    if gaps:
+        observed = sum(gaps) / len(gaps)
+        avg_interval = observed if not avg_interval else (1 - SCHEDULER_EMA_ALPHA) * avg_interval + SCHEDULER_EMA_ALPHA * observed
+    if new_posts:
+        last_post_ts = new_posts[-1]
+
+    dormant_until = 0
+    if now_ts - last_post_ts > SCHEDULER_DORMANT_DAYS * 86400:
+        dormant_until = int(now_ts + SCHEDULER_DORMANT_TTL_HOURS * 3600)
+
+    with conn:
+        conn.execute(
+            "UPDATE followings SET last_post_ts = ?, avg_interval = ?, last_checked = ?, dormant_until = ? WHERE username = ?",
+            (last_post_ts, avg_interval, int(now_ts), dormant_until, username)
+        )
+
+def scheduler_due_ts(last_post_ts, avg_interval, last_checked):
+    if not last_checked:
+        return 0
+    predicted = last_post_ts + avg_interval
+    due = max(predicted, last_checked + SCHEDULER_MIN_RECHECK_MINUTES * 60)
+    return min(due, last_checked + SCHEDULER_MAX_SKIP_HOURS * 3600)
+
+def queue_schedule(conn):
+    now_ts = time.time()
+    heap = []
+    skipped, dormant = 0, 0
+    rows = conn.execute(
+        "SELECT username, pos, last_post_ts, avg_interval, last_checked, dormant_until FROM followings"
+    )
+    for username, pos, last_post_ts, avg_interval, last_checked, dormant_until in rows:
+        if dormant_until > now_ts:
+            dormant += 1
+            continue
+        due = scheduler_due_ts(last_post_ts, avg_interval, last_checked)
+        if due > now_ts:
+            skipped += 1
+            continue
+        heap.append((due, pos, username))
+    heapq.heapify(heap)
+    order = [heapq.heappop(heap)[2] for _ in range(len(heap))]
+    print(f"[Планировщик] К проверке {len(order)}, рано проверять {skipped}, спящих {dormant}.")
+    return order
+
+def queue_username_by_pk(conn, pk):
+    row = conn.execute("SELECT username FROM followings WHERE pk = ?", (pk,)).fetchone()
+    return row[0] if row else None
+
+def queue_mark_seen(conn, pks, sync_id):
+    with conn:
+        conn.executemany("UPDATE followings SET seen_sync = ? WHERE pk = ?", ((sync_id, pk) for pk in pks))
+
+def queue_remove_unseen(conn, sync_id):
+    # Всё, что не встретилось за полную синхронизацию sync_id, - отписки. Вызывается только после того,
+    # как пройдены все страницы (ошибка посреди сверки пробрасывается раньше). Записи без pk
+    # (из старого текстового списка) не удаляются: по ним не отличить отписку от переименования,
+    # pk им назначит resolve_user_pk. Отметки более новой сверки (seen_sync > sync_id) отписками не считаются
+    with conn:
+        cur = conn.execute("DELETE FROM followings WHERE seen_sync < ? AND pk IS NOT NULL", (sync_id,))
+    return cur.rowcount
+
+def queue_get_meta(conn, key, default=None):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def queue_set_meta(conn, key, value):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+def queue_remove(conn, username):
+    with conn:
+        conn.execute("DELETE FROM followings WHERE username = ?", (username,))
+
+def queue_rotate(conn, username):
+    with conn:
+        conn.execute(
+            "UPDATE followings SET pos = (SELECT MAX(pos) FROM followings) + 1 WHERE username = ?",
+            (username,)
+        )
+
+# ----------------------------------------------------
+# 7. ИНДЕКС ПРОКОММЕНТИРОВАННЫХ ПОСТОВ
+# ----------------------------------------------------
+
+# Строка журнала: "<media_id>\t<unix_ts>". Старые строки без времени считаются записанными сейчас.
+
+def parse_commented_line(line, default_ts):
+    parts = line.strip().split('\t')
+    try:
+        ts = int(parts[1]) if len(parts) > 1 else default_ts
+    except ValueError:
+        ts = default_ts
+    return parts[0], ts
+
+def compact_commented_log(path, index):
+    # Посты старше POST_CUTOFF_HOURS отсекаются по возрасту раньше, их записи больше не нужны.
+    # Журнал читается построчно, поэтому компакция не держит всю историю в памяти.
+    if not os.path.exists(path):
+        open(path, 'w').close()
+    now_ts = int(time.time())
+    cutoff_ts = now_ts - POST_CUTOFF_HOURS * 3600
+    total, kept = 0, 0
+    tmp_path = path + ".tmp"
+    with open(path, 'r') as src, open(tmp_path, 'w') as dst:
+        for line in src:
+            media_id, ts = parse_commented_line(line, now_ts)
+            if not media_id:
+                continue
+            total += 1
+            if ts < cutoff_ts:
+                if media_id in index:
+                    del index[media_id]
+                continue
+            dst.write(f"{media_id}\t{ts}\n")
+            index[media_id] = str(ts)
+            kept += 1
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp_path, path)
+    print(f"[Индекс комментариев] Компакция: было {total}, осталось {kept}.")
+
+def open_commented_index(session_path):
+    # Журнал у каждой сессии свой; общий commented.txt из старых версий копируется при первом запуске
+    path = os.path.join(session_path, COMMENTED_LOG)
+    if not os.path.exists(path) and os.path.exists(COMMENTED_LOG):
+        shutil.copyfile(COMMENTED_LOG, path)
+    if COMMENTED_INDEX_BACKEND == "dbm":
+        index = dbm.open(path + ".idx", 'c')
+    else:
+        index = {}
+    compact_commented_log(path, index)
+    print(f"[Индекс комментариев] Загружено {len(index)} записей ({COMMENTED_INDEX_BACKEND}).")
+    return {"path": path, "index": index}
+
+def close_commented_index(commented):
+    # У dbm-индекса есть файловый дескриптор и блокировка; set в памяти закрывать не нужно
+    if hasattr(commented["index"], "close"):
+        commented["index"].close()
+
+COMMENTED_LOCK = threading.Lock()
+
+def is_commented(commented, media_id):
+    with COMMENTED_LOCK:
+        return media_id in commented["index"]
+
+def mark_commented(commented, media_id):
+    ts = str(int(time.time()))
+    with COMMENTED_LOCK:
+        with open(commented["path"], 'a') as f:
+            f.write(f"{media_id}\t{ts}\n")
+        commented["index"][media_id] = ts
+
+# ----------------------------------------------------
+# 8. ЖУРНАЛ ПОСТОВ
+# ----------------------------------------------------
+
+# {session}/journal.db - журнал каждого поста-кандидата по стадиям:
+# discovered -> described -> generated -> posted (+ liked отдельно), либо skipped (отказ модели или пустой
+# комментарий - повторять бессмысленно) или abandoned (кончились попытки).
+# Описание и комментарий сохраняются сразу после генерации, поэтому после падения или ошибки
+# media_comment пост публикуется из журнала без повторных запросов к OpenAI.
+# В outbox попадают только посты с назначенным next_attempt: сбой OpenAI, неудачная публикация или лайк
+# (повтор через OUTBOX_RETRY_MINUTES * 2^(попытка-1), не больше OUTBOX_MAX_ATTEMPTS раз) и недоделанные
+# прошлым запуском (их open_journal делает доступными сразу). Посты текущего прохода outbox не трогает.
+
+JOURNAL_LOCK = threading.Lock()
+_journal_conn = None
+
+def open_journal(session_path):
+    global _journal_conn
+    conn = sqlite3.connect(os.path.join(session_path, "journal.db"), check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    with conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS posts ("
+            "media_id TEXT PRIMARY KEY, user TEXT NOT NULL, code TEXT, taken_at REAL, media_type INTEGER, "
+            "caption TEXT, images TEXT, state TEXT NOT NULL, description TEXT, comment TEXT, "
+            "tokens INTEGER NOT NULL DEFAULT 0, cost REAL NOT NULL DEFAULT 0, liked INTEGER NOT NULL DEFAULT 0, "
+            "attempts INTEGER NOT NULL DEFAULT 0, like_attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt REAL NOT NULL DEFAULT 0, last_error TEXT, updated INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_state ON posts(state)")
+        conn.execute(
+            "DELETE FROM posts WHERE updated < ? AND "
+            "(state IN ('abandoned', 'skipped') OR (state = 'posted' AND liked != 0))",
+            (int(time.time()) - JOURNAL_RETENTION_DAYS * 86400,)
+        )
+        # Прошлый запуск оборвался на этих постах - допубликуем их из outbox
+        conn.execute(
+            "UPDATE posts SET next_attempt = ? WHERE next_attempt = 0 AND "
+            "(state IN ('discovered', 'described', 'generated') OR (state = 'posted' AND liked = 0))",
+            (time.time(),)
+        )
+    _journal_conn = conn
+    return conn
+
+def close_journal():
+    global _journal_conn
+    with JOURNAL_LOCK:
+        if _journal_conn is not None:
+            _journal_conn.close()
+            _journal_conn = None
+
+def journal_get(media_id):
+    with JOURNAL_LOCK:
+        row = _journal_conn.execute("SELECT * FROM posts WHERE media_id = ?", (media_id,)).fetchone()
+    return dict(row) if row else None
+
+def journal_discovered(user, post):
+    # False - пост уже пропущен, брошен или ждёт повтора в outbox, поиском его не берём
+    with JOURNAL_LOCK, _journal_conn:
+        _journal_conn.execute(
+            "INSERT OR IGNORE INTO posts (media_id, user, code, taken_at, media_type, caption, images, state, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, 'discovered', ?)",
+            (post.id, user, post.code, post.taken_at, post.media_type, post.caption_text,
+             json.dumps(post.images), int(time.time()))
+        )
+        state, next_attempt = _journal_conn.execute(
+            "SELECT state, next_attempt FROM posts WHERE media_id = ?", (post.id,)
+        ).fetchone()
+    return state not in ("skipped", "abandoned") and next_attempt == 0
+
+def journal_advance(media_id, state, **fields):
+    fields.update(state=state, updated=int(time.time()))
+    if state == "posted":
+        fields.update(attempts=0, next_attempt=0, last_error=None)
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    with JOURNAL_LOCK, _journal_conn:
+        _journal_conn.execute(f"UPDATE posts SET {columns} WHERE media_id = ?", (*fields.values(), media_id))
+
+def journal_failed(media_id, error, like=False):
+    # Следующая попытка - с экспоненциальной паузой; после OUTBOX_MAX_ATTEMPTS пост (или лайк) бросаем
+    counter = "like_attempts" if like else "attempts"
+    with JOURNAL_LOCK, _journal_conn:
+        row = _journal_conn.execute(f"SELECT {counter} FROM posts WHERE media_id = ?", (media_id,)).fetchone()
+        if row is None:
+            return
+        attempts = row[0] + 1
+        delay = OUTBOX_RETRY_MINUTES * 60 * 2 ** (attempts - 1)
+        _journal_conn.execute(
+            f"UPDATE posts SET {counter} = ?, next_attempt = ?, last_error = ?, updated = ? WHERE media_id = ?",
+            (attempts, time.time() + delay, str(error)[:500], int(time.time()), media_id)
+        )
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            if like:
+                _journal_conn.execute("UPDATE posts SET liked = -1 WHERE media_id = ?", (media_id,))
+            else:
+                _journal_conn.execute("UPDATE posts SET state = 'abandoned' WHERE media_id = ?", (media_id,))
+
+def journal_due(until=None):
+    # Outbox: недоделанные посты и непоставленные лайки, у которых подошло время повтора (к until, по умолчанию сейчас)
+    with JOURNAL_LOCK:
+        rows = _journal_conn.execute(
+            "SELECT * FROM posts WHERE next_attempt > 0 AND next_attempt <= ? AND "
+            "(state IN ('discovered', 'described', 'generated') OR (state = 'posted' AND liked = 0)) "
+            "ORDER BY taken_at DESC", (time.time() if until is None else until,)
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+def journal_counts():
+    with JOURNAL_LOCK:
+        return dict(_journal_conn.execute("SELECT state, COUNT(*) FROM posts GROUP BY state").fetchall())
+
+# ----------------------------------------------------
+# 9. ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ INSTAGRAM
+# ----------------------------------------------------
+
+# Каждый тип запроса берёт жетон из своего token bucket (RATE_LIMITS). После 429 тип запроса
+# блокируется на экспоненциально растущую паузу со случайным разбросом; следующий запрос после паузы
+# проверяет, снят ли лимит, и первый же успешный сбрасывает паузу к RATE_BACKOFF_BASE.
+
+RATE_LOCK = threading.Lock()
+RATE_BUCKETS = {}
+
+# Instagram-клиент общий для стадий конвейера, запросы через него идут по одному.
+# RLock: пересоздание сессии держит его целиком и само делает запросы через rate_limited_call
+IG_LOCK = threading.RLock()
+
+def _rate_bucket(endpoint):
+    bucket = RATE_BUCKETS.get(endpoint)
+    if bucket is None:
+        per_minute, capacity = RATE_LIMITS[endpoint]
+        bucket = {"rate": per_minute / 60.0, "capacity": capacity, "tokens": capacity,
+                  "updated": time.time(), "failures": 0, "blocked_until": 0.0}
+        RATE_BUCKETS[endpoint] = bucket
+    return bucket
+
+def rate_acquire(endpoint):
+    while True:
+        with RATE_LOCK:
+            bucket = _rate_bucket(endpoint)
+            now = time.time()
+            bucket["tokens"] = min(bucket["capacity"], bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+            bucket["updated"] = now
+            if now < bucket["blocked_until"]:
+                wait = bucket["blocked_until"] - now
+            elif bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                return
+            else:
+                wait = (1 - bucket["tokens"]) / bucket["rate"]
+        if wait > 5:
+            print(f"[RATE] {endpoint}: ждём {wait:.0f}с...")
+        time.sleep(wait)
+
+def rate_backoff(endpoint, reason=""):
+    with RATE_LOCK:
+        bucket = _rate_bucket(endpoint)
+        bucket["failures"] += 1
+        delay = min(RATE_BACKOFF_MAX, RATE_BACKOFF_BASE * 2 ** (bucket["failures"] - 1))
+        delay *= random.uniform(0.5, 1.5)
+        bucket["blocked_until"] = time.time() + delay
+        bucket["tokens"] = 0
+        failures = bucket["failures"]
+    msg = f"[RATE] Лимит на {endpoint} ({reason or 'rate limit'}), попытка {failures}, пауза {delay / 60:.1f} мин."
+    print(msg)
+    send_telegram_message(msg)
+    return delay
+
+def rate_success(endpoint):
+    with RATE_LOCK:
+        _rate_bucket(endpoint)["failures"] = 0
+
+def is_user_not_found_error(e):
+    exceptions = sys.modules.get("instagrapi.exceptions")
+    return exceptions is not None and isinstance(e, exceptions.UserNotFound)
+
+def is_rate_limit_error(e):
+    # instagrapi импортируется лениво: пока он не загружен, его исключений быть не может
+    exceptions = sys.modules.get("instagrapi.exceptions")
+    if exceptions is not None and isinstance(
+        e, (exceptions.PleaseWaitFewMinutes, exceptions.RateLimitError, exceptions.ClientThrottledError)
+    ):
+        return True
+    # Код ответа, а не "429" в тексте: в сообщениях бывают id медиа и pk, в которых встречаются эти цифры
+    response = getattr(e, "response", None)
+    if getattr(response, "status_code", None) == 429 or getattr(e, "code", None) == 429:
+        return True
+    text = str(e).lower()
+    return "rate limit" in text or "please wait a few minutes" in text
+
+def rate_limited_call(endpoint, fn, *args, **kwargs):
+    # Ждём жетон вне IG_LOCK, чтобы пауза одного типа запросов не держала остальные
+    with metric_timer("ig_rate_wait"):
+        rate_acquire(endpoint)
+    metric_inc("ig_requests_total", endpoint=endpoint)
+    try:
+        with IG_LOCK, metric_timer(f"ig_{endpoint}"):
+            result = fn(*args, **kwargs)
+    except Exception as e:
+        if is_rate_limit_error(e):
+            metric_inc("ig_rate_limited_total", endpoint=endpoint)
+            rate_backoff(endpoint, type(e).__name__)
+        else:
+            metric_inc("ig_errors_total", endpoint=endpoint)
+        raise
+    rate_success(endpoint)
+    return result
+
+# ----------------------------------------------------
+# 10. СОЗДАНИЕ / ВЫБОР СЕССИИ
+# ----------------------------------------------------
+
+def new_instagram_client():
+    # instagrapi (pydantic-модели) грузится долго, поэтому импортируется только когда нужен клиент
+    from instagrapi import Client
+    return Client()
+
+def is_interactive():
+    return sys.stdin is not None and sys.stdin.isatty()
+
+def wait_for_operator(msg):
+    # Без терминала (супервизор, systemd, cron) нажать Enter некому: падаем вместо вечного ожидания
+    if not is_interactive():
+        raise RuntimeError(f"{msg} Нужен оператор, но терминала нет.")
+    print(msg)
+    input()
+
+def create_new_session(session_name=None, ig_login=None, ig_pass=None):
+    session_name = session_name or input("Введите имя новой сессии: ")
     session_path = os.path.join(SESSIONS_DIR, session_name)
     os.makedirs(session_path, exist_ok=True)
-    ig_login = input("Instagram Login: ")
-    ig_pass = input("Instagram Password: ")
+    ig_login = ig_login or input("Instagram Login: ")
+    ig_pass = ig_pass or input("Instagram Password: ")
 
-    cl = Client()
+    cl = new_instagram_client()
     try:
         print("[INFO] Попытка входа (создание новой сессии).")
         cl.login(ig_login, ig_pass)
     except Exception as e:
         if "two-factor" in str(e).lower() or "2fa" in str(e).lower():
-            print("[WARNING] 2FA. Введите код и нажмите Enter...")
-            input()
+            try:
+                wait_for_operator("[WARNING] 2FA. Введите код и нажмите Enter...")
+            except RuntimeError as e2:
+                log_error(f"Session Creation Error (2FA): {e2}")
+                return None
             try:
                 cl.login(ig_login, ig_pass)
             except Exception as e2:
@@ -164,7 +1040,7 @@ def create_new_session():
         'openai_tokens_cost': '0.0'
     }
     cfg['Comments'] = {'comments_done': ''}  # Добавляем секцию Comments
-    cfg['Session'] = {'path': session_path}
+    cfg['Session'] = {'path': session_path, 'checked_at': str(int(time.time()))}
 
     save_config(session_path, cfg)
     cl.dump_settings(os.path.join(session_path, 'session.json'))
@@ -194,9 +1070,36 @@ def select_session():
     return None
 
 # ----------------------------------------------------
-# 6. ПЕРЕСОЗДАНИЕ СЕССИИ
+# 11. ПЕРЕСОЗДАНИЕ СЕССИИ
 # ----------------------------------------------------
 
+# Пересоздание идёт целиком под IG_LOCK, чтобы никто не отправил запрос через клиент посреди logout/login,
+# и только в основном потоке: там идёт публикация и там можно ждать оператора (wait_for_operator).
+# Фоновый поиск конвейера кладёт запрос в ready_q и ждёт, пока основной поток его выполнит.
+
+SESSION_RECREATE = object()  # Маркер запроса на пересоздание сессии в ready_q конвейера
+_session_owner = None  # (основной поток, ready_q) идущего конвейера
+
+def recreate_session(cl, session_path):
+    owner = _session_owner
+    if owner is not None and threading.current_thread() is not owner[0]:
+        request = {"done": threading.Event(), "error": None}
+        owner[1].put((SESSION_RECREATE, request))
+        request["done"].wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return
+    with IG_LOCK:
+        remove_and_recreate_session(cl, session_path)
+
+def serve_session_request(cl, session_path, request):
+    try:
+        recreate_session(cl, session_path)
+    except Exception as e:
+        request["error"] = e
+    finally:
+        request["done"].set()
+
 def remove_and_recreate_session(cl, session_path):
     while True:
         try:
@@ -206,9 +1109,8 @@ def remove_and_recreate_session(cl, session_path):
             break
         except Exception as e:
             err_str = f"[ERROR] logout failed: {e}\nНажмите Enter, чтобы повторить logout (или Ctrl+C для выхода)."
-            print(err_str)
             send_telegram_message(err_str)
-            input()
+            wait_for_operator(err_str)
 
     session_file = os.path.join(session_path, 'session.json')
     if os.path.exists(session_file):
@@ -223,50 +1125,68 @@ def remove_and_recreate_session(cl, session_path):
     while True:
         try:
             print("[INFO] Логин после logout...")
-            cl.login(ig_login, ig_pass)
+            rate_limited_call("login", cl.login, ig_login, ig_pass)
             print("[SUCCESS] Перелогин прошёл успешно.")
             profile = cl.user_info_by_username(ig_login)
-            cfg['Instagram']['ig_id'] = str(profile.pk)
-            cfg['Instagram']['ig_username'] = profile.username
-            cfg['Instagram']['ig_full_name'] = profile.full_name
-            cfg['Instagram']['ig_profile_pic'] = str(profile.profile_pic_url)
-            cfg['Instagram']['ig_profile_description'] = profile.biography
-
             cl.dump_settings(session_file)
-            save_config(session_path, cfg)
+            with CONFIG_LOCK:
+                cfg['Instagram']['ig_id'] = str(profile.pk)
+                cfg['Instagram']['ig_username'] = profile.username
+                cfg['Instagram']['ig_full_name'] = profile.full_name
+                cfg['Instagram']['ig_profile_pic'] = str(profile.profile_pic_url)
+                cfg['Instagram']['ig_profile_description'] = profile.biography
+                cfg['Session']['checked_at'] = str(int(time.time()))
+                save_config(session_path, cfg)
             print("[SUCCESS] Сессия пересоздана полностью.")
             break
         except Exception as e:
             if "two-factor" in str(e).lower() or "2fa" in str(e).lower():
-                print("[WARNING] 2FA. Введите код, Enter...")
-                input()
+                wait_for_operator("[WARNING] 2FA. Введите код, Enter...")
                 continue
             elif "challenge_required" in str(e).lower():
-                print("[WARNING] Challenge required. Подтвердите в IG, Enter...")
-                input()
-                continue
-            elif "429" in str(e):
-                print("[ERROR] 429 при пересоздании, спим по SLEEP_INTERVALS")
-                send_telegram_message("429 при пересоздании сессии, уходим в прогрессивный сон")
-                for mins in SLEEP_INTERVALS:
-                    print(f"Сон {mins} мин...")
-                    time.sleep(mins * 60)
+                wait_for_operator("[WARNING] Challenge required. Подтвердите в IG, Enter...")
                 continue
+            elif is_rate_limit_error(e):
+                continue  # Пауза уже назначена в rate_limited_call
             else:
                 err_str = f"[ERROR] Ошибка при пересоздании сессии: {e}\nНажмите Enter, чтобы повторить (или Ctrl+C)"
-                print(err_str)
                 send_telegram_message(err_str)
-                input()
+                wait_for_operator(err_str)
 
 # ----------------------------------------------------
-# 7. ИНИЦИАЛИЗАЦИЯ CLIENT
+# 12. ИНИЦИАЛИЗАЦИЯ CLIENT
 # ----------------------------------------------------
 
+# Сохранённая сессия не логинится заново. Если её проверяли меньше SESSION_TRUST_MINUTES назад,
+# она используется сразу (быстрый перезапуск), иначе проверяется одним лёгким запросом account_info.
+# Логин - только если сессии нет или Instagram её отверг.
+
+def mark_session_checked(session_path, cfg):
+    # Только после настоящей проверки (account_info или логин): иначе частые перезапуски продлевали бы
+    # доверие к сессии бесконечно
+    with CONFIG_LOCK:
+        cfg['Session']['checked_at'] = str(int(time.time()))
+        save_config(session_path, cfg)
+
+def validate_saved_session(cl, cfg, session_path):
+    checked_at = int(cfg['Session'].get('checked_at', 0))
+    if time.time() - checked_at < SESSION_TRUST_MINUTES * 60:
+        return True
+    try:
+        rate_limited_call("user_info", cl.account_info)
+        mark_session_checked(session_path, cfg)
+        return True
+    except Exception as e:
+        if is_rate_limit_error(e):
+            return True  # Лимит не говорит о том, что сессия плохая
+        log_error(f"Сохранённая сессия недействительна: {e}")
+        return False
+
 def init_instagram_client(session_path):
     cfg = load_config(session_path)
     ig_login = cfg['Instagram']['ig_login']
     ig_pass = cfg['Instagram']['ig_pass']
-    cl = Client()
+    cl = new_instagram_client()
 
     session_file = os.path.join(session_path, 'session.json')
     need_login = True
@@ -274,341 +1194,1940 @@ def init_instagram_client(session_path):
     if os.path.exists(session_file):
         try:
             cl.load_settings(session_file)
-            cl.login(ig_login, ig_pass)
-            print(f"[SUCCESS] Авторизация через сохранённую сессию: {ig_login}")
-            need_login = False
+            cl.username, cl.password = ig_login, ig_pass
+            if cl.user_id and validate_saved_session(cl, cfg, session_path):
+                print(f"[SUCCESS] Авторизация через сохранённую сессию: {ig_login}")
+                need_login = False
         except Exception as e:
             log_error(f"Ошибка автологина: {e}")
 
     while need_login:
         try:
             print("[INFO] Пробуем логин...")
-            cl.login(ig_login, ig_pass)
+            rate_limited_call("login", cl.login, ig_login, ig_pass)
             print(f"[SUCCESS] Вход: {ig_login}")
             break
         except Exception as e:
             if "two-factor" in str(e).lower() or "2fa" in str(e).lower():
-                print("[WARNING] 2FA. Введите код, Enter...")
-                input()
+                wait_for_operator("[WARNING] 2FA. Введите код, Enter...")
                 continue
             elif "challenge_required" in str(e).lower():
-                print("[WARNING] Challenge. Подтвердите в IG, Enter...")
-                input()
-                continue
-            elif "429" in str(e):
-                print("[ERROR] Лимит 429 при init. Спим...")
-                for mins in SLEEP_INTERVALS:
-                    print(f"Сон {mins} минут...")
-                    time.sleep(mins * 60)
+                wait_for_operator("[WARNING] Challenge. Подтвердите в IG, Enter...")
                 continue
+            elif is_rate_limit_error(e):
+                continue  # Пауза уже назначена в rate_limited_call
             else:
                 log_error(f"Login error init: {e}")
-                for mins in SLEEP_INTERVALS:
-                    print(f"Сон {mins} мин...")
-                    time.sleep(mins * 60)
+                rate_backoff("login", "login error")
 
     cl.dump_settings(session_file)
+    if need_login:
+        mark_session_checked(session_path, cfg)
     return cl, cfg
 
 # ----------------------------------------------------
-# 8. ПОДСЧЁТ OPENAI
+# 13. ПОДСЧЁТ OPENAI
+# ----------------------------------------------------
+
+# Каждый вызов OpenAI копится в памяти и раз в USAGE_FLUSH_INTERVAL секунд (и при завершении)
+# дописывается в {session}/openai_usage.jsonl. В ig_login.ini остаются только суммарные счётчики.
+
+USAGE_LOCK = threading.Lock()
+USAGE_BUFFER = []
+
+# В режиме супервизора воркеры делят семафор на число запросов к OpenAI и общий счётчик расходов.
+# Сколько мест семафора держит каждый воркер, видно в OPENAI_GATE_HELD (pid -> число): места упавшего
+# или снятого terminate воркера супервизор возвращает сам
+OPENAI_GATE = None
+OPENAI_GATE_HELD = None
+OPENAI_SPEND = None
+GATE_HELD_LOCK = threading.Lock()
+_gate_held = 0
+
+def _count_gate(delta):
+    global _gate_held
+    if OPENAI_GATE_HELD is None:
+        return
+    with GATE_HELD_LOCK:
+        _gate_held += delta
+        OPENAI_GATE_HELD[os.getpid()] = _gate_held
+
+def take_gate(gate, timeout):
+    # Сначала место, потом учёт, а при возврате наоборот: падение между шагами теряет место, но никогда
+    # не даёт супервизору вернуть лишнее
+    if not gate.acquire(True, timeout):
+        return False
+    _count_gate(1)
+    return True
+
+def release_gate(gate):
+    _count_gate(-1)
+    gate.release()
+
+def openai_budget_exceeded():
+    return OPENAI_SPEND is not None and SUPERVISOR_COST_BUDGET > 0 and OPENAI_SPEND.value >= SUPERVISOR_COST_BUDGET
+
+def add_openai_usage(config, input_tokens, output_tokens, cost, cached_tokens=0, image_tokens_saved=0):
+    metric_inc("openai_tokens_total", input_tokens, kind="input")
+    metric_inc("openai_tokens_total", output_tokens, kind="output")
+    metric_inc("openai_tokens_total", cached_tokens, kind="cached")
+    metric_inc("openai_cost_dollars_total", cost)
+    metric_inc("openai_image_tokens_saved_total", image_tokens_saved)
+    if OPENAI_SPEND is not None:
+        with OPENAI_SPEND.get_lock():
+            OPENAI_SPEND.value += cost
+    with USAGE_LOCK:
+        USAGE_BUFFER.append({
+            "ts": int(time.time()),
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cached_tokens": cached_tokens,
+            "cost": cost,
+            "image_tokens_saved": image_tokens_saved,
+        })
+
+def flush_openai_usage(config):
+    with USAGE_LOCK:
+        entries = USAGE_BUFFER[:]
+        USAGE_BUFFER.clear()
+    if not entries:
+        return
+
+    session_path = config['Session']['path']
+    with open(os.path.join(session_path, 'openai_usage.jsonl'), 'a', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    input_tokens = sum(e["input_tokens"] for e in entries)
+    output_tokens = sum(e["output_tokens"] for e in entries)
+    cached_tokens = sum(e.get("cached_tokens", 0) for e in entries)
+    cost = sum(e["cost"] for e in entries)
+    with CONFIG_LOCK:
+        old_in = int(config['OpenAI'].get('openai_input_tokens_consumed', 0))
+        old_cached = int(config['OpenAI'].get('openai_cached_tokens_consumed', 0))
+        old_out = int(config['OpenAI'].get('openai_output_tokens_consumed', 0))
+        old_total = int(config['OpenAI'].get('openai_total_tokens_consumed', 0))
+        old_cost = float(config['OpenAI'].get('openai_tokens_cost', 0.0))
+
+        config['OpenAI']['openai_input_tokens_consumed'] = str(old_in + input_tokens)
+        config['OpenAI']['openai_cached_tokens_consumed'] = str(old_cached + cached_tokens)
+        config['OpenAI']['openai_output_tokens_consumed'] = str(old_out + output_tokens)
+        config['OpenAI']['openai_total_tokens_consumed'] = str(old_total + input_tokens + output_tokens)
+        config['OpenAI']['openai_tokens_cost'] = str(old_cost + cost)
+        save_config(session_path, config)
+
+def start_usage_flusher(config):
+    def loop():
+        while True:
+            time.sleep(USAGE_FLUSH_INTERVAL)
+            try:
+                flush_openai_usage(config)
+            except Exception as e:
+                log_error(f"[OPENAI] Ошибка сохранения учёта токенов: {e}")
+
+    threading.Thread(target=loop, name="usage-flusher", daemon=True).start()
+
+# ----------------------------------------------------
+# 14. ШАБЛОНЫ ПРОМПТОВ
+# ----------------------------------------------------
+
+# Каждый запрос начинается с неизменного system-сообщения, одинакового до байта для всех постов,
+# а всё переменное (описание поста, описание картинки, сама картинка) идёт после него в user-сообщении
+# как JSON, поэтому кавычки в описании ничего не ломают.
+# Кеш префикса OpenAI срабатывает только с PROMPT_CACHE_MIN_TOKENS токенов, а эти промпты - около
+# 50-200 токенов, так что cached_tokens сейчас 0. Раздувать промпт ради кеша невыгодно: 1024 токена
+# со скидкой за кеш стоят дороже 200 без неё. Порядок пригодится, если персона и правила вырастут.
+# Описание поста обрезается до CAPTION_TOKEN_BUDGET токенов (tiktoken, без него - оценка по байтам).
+
+COMMENT_PERSONA = "You are writing comments for Instagram posts of your followings. About you: You are witty art creator Alexander. You do create engaging, narrative-rich, sometimes with humor, comments that resonate emotionally and intellectually with the audience and, importantly, complementing autor of publication and his/her post in particular."
+COMMENT_RULES = "'Comment Language': 'Equal to Post Caption language, otherwise English', 'Comment Length': 30 - 120 symbols, 'Additional Rules': 'Use \"About you\" as reference for comment styling indirectly, do not reuse info About you directly in commentaries you produce; Rarely use emojis; Never use #hashtags.'"
+
+PROMPT_DESCRIBE_IMAGE = "Please very precisely describe this Instagram image, focusing on the style of depicting, guessing the mood, interpreting the meaning, and admitting any unique traits. If the image contains text, then scan it and include text unchanged into the description."
+PROMPT_COMMENT = (
+    f"{COMMENT_PERSONA}\n\n{COMMENT_RULES}\n\n"
+    "The user message is a JSON object with the post 'caption' and 'image_description' (AI-estimation). "
+    "Reply with the comment text only."
+)
+PROMPT_COMMENT_MULTIMODAL = (
+    f"{COMMENT_PERSONA}\n\n{COMMENT_RULES}\n\n"
+    "The user message is a JSON object with the post 'caption', followed by the post image. "
+    "Also return a short description of the image (1-2 sentences) in 'description', and set 'refused' "
+    "to true with an empty comment if you can not see or describe the image."
+)
+
+PROMPT_CACHE_MIN_TOKENS = 1024  # С какой длины общего префикса OpenAI кеширует промпт
+
+_tokenizer = None
+
+def get_tokenizer():
+    # o200k_base - кодировка gpt-4o / gpt-4o-mini. При первой загрузке tiktoken может скачивать словарь,
+    # при ошибке остаёмся на оценке
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = False
+        if tiktoken is not None:
+            try:
+                _tokenizer = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                print(f"[OPENAI] tiktoken недоступен ({e}), токены считаются приблизительно.")
+    return _tokenizer or None
+
+def count_tokens(text):
+    encoding = get_tokenizer()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return -(-len(text.encode("utf-8")) // 3)  # С запасом: латиница ~4 байта на токен, кириллица больше
+
+def trim_to_token_budget(text, budget):
+    tokens = count_tokens(text)
+    if tokens <= budget:
+        return text
+    encoding = get_tokenizer()
+    if encoding is not None:
+        trimmed = encoding.decode(encoding.encode(text)[:budget])
+    else:
+        trimmed = text[:len(text) * budget // tokens]
+    metric_inc("captions_trimmed_total")
+    return trimmed.rstrip() + "…"
+
+def prompt_payload(**fields):
+    return json.dumps(fields, ensure_ascii=False)
+
+def describe_image_messages(image_url):
+    return [
+        {"role": "system", "content": PROMPT_DESCRIBE_IMAGE},
+        {"role": "user", "content": [{"type": "image_url", "image_url": {"url": image_url, "detail": IMAGE_DETAIL}}]},
+    ]
+
+def comment_messages(caption, image_desc):
+    return [
+        {"role": "system", "content": PROMPT_COMMENT},
+        {"role": "user", "content": prompt_payload(
+            caption=trim_to_token_budget(caption, CAPTION_TOKEN_BUDGET), image_description=image_desc
+        )},
+    ]
+
+def comment_multimodal_messages(caption, image_url):
+    return [
+        {"role": "system", "content": PROMPT_COMMENT_MULTIMODAL},
+        {"role": "user", "content": [
+            {"type": "text", "text": prompt_payload(caption=trim_to_token_budget(caption, CAPTION_TOKEN_BUDGET))},
+            {"type": "image_url", "image_url": {"url": image_url, "detail": IMAGE_DETAIL}},
+        ]},
+    ]
+
+# ----------------------------------------------------
+# 15. OPENAI ФУНКЦИИ
 # ----------------------------------------------------
 
-def add_openai_usage(config, input_tokens, output_tokens, cost):
-    total_tokens = input_tokens + output_tokens
-    old_in = int(config['OpenAI'].get('openai_input_tokens_consumed', 0))
-    old_out = int(config['OpenAI'].get('openai_output_tokens_consumed', 0))
-    old_total = int(config['OpenAI'].get('openai_total_tokens_consumed', 0))
-    old_cost = float(config['OpenAI'].get('openai_tokens_cost', 0.0))
 
-    config['OpenAI']['openai_input_tokens_consumed'] = str(old_in + input_tokens)
-    config['OpenAI']['openai_output_tokens_consumed'] = str(old_out + output_tokens)
-    config['OpenAI']['openai_total_tokens_consumed'] = str(old_total + total_tokens)
-    config['OpenAI']['openai_tokens_cost'] = str(old_cost + cost)
+# Все запросы к OpenAI идут через один AsyncOpenAI (общий пул соединений) в event loop фонового потока.
+# Одновременно в полёте не больше OPENAI_MAX_IN_FLIGHT запросов, у каждого дедлайн OPENAI_REQUEST_TIMEOUT.
+# Повторяются только 429 (кроме исчерпанной квоты), 5xx, обрывы и таймауты; остальные ошибки сразу наверх.
+# Синхронный код (последовательный режим) ждёт результат через run_ai.
+
+_ai_loop = None
+_ai_loop_lock = threading.Lock()
+_ai_semaphore = None
+
+def ai_loop():
+    global _ai_loop
+    with _ai_loop_lock:
+        if _ai_loop is None:
+            loop = asyncio.new_event_loop()
+            # Свой пул для to_thread и ожидания очередей конвейера, не зависящий от числа CPU
+            loop.set_default_executor(ThreadPoolExecutor(OPENAI_MAX_IN_FLIGHT * 2 + 4, thread_name_prefix="openai-io"))
+            threading.Thread(target=loop.run_forever, name="openai-loop", daemon=True).start()
+            _ai_loop = loop
+    return _ai_loop
+
+def run_ai(coro):
+    return asyncio.run_coroutine_threadsafe(coro, ai_loop()).result()
+
+def create_ai_client(api_key, base_url=None):
+    from openai import AsyncOpenAI
+
+    async def create():
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=OPENAI_REQUEST_TIMEOUT)
+
+    return run_ai(create())
+
+def is_retryable_openai_error(e):
+    import openai
+    if isinstance(e, asyncio.TimeoutError):
+        return True
+    if isinstance(e, openai.RateLimitError):
+        return getattr(e, "code", None) != "insufficient_quota"
+    return isinstance(e, (openai.InternalServerError, openai.APIConnectionError))
+
+async def acquire_gate(gate):
+    # Общий семафор супервизора - межпроцессный, ждём его в потоке короткими попытками.
+    # Если корутину отменят (таймаут слайдов, wait_for, остановка), поток всё равно может взять место
+    # уже после отмены - тогда его возвращает done-callback, иначе каждая отмена навсегда сужала бы семафор
+    loop = asyncio.get_running_loop()
+
+    def release_if_acquired(attempt):
+        if not attempt.cancelled() and attempt.exception() is None and attempt.result():
+            release_gate(gate)
+
+    while True:
+        attempt = loop.run_in_executor(None, take_gate, gate, 1.0)
+        try:
+            if await asyncio.shield(attempt):
+                return
+        except asyncio.CancelledError:
+            attempt.add_done_callback(release_if_acquired)
+            raise
+
+async def _openai_request(ai_client, kwargs):
+    global _ai_semaphore
+    if _ai_semaphore is None:
+        _ai_semaphore = asyncio.Semaphore(OPENAI_MAX_IN_FLIGHT)
+    async with _ai_semaphore:
+        gate = OPENAI_GATE
+        if gate is not None:
+            await acquire_gate(gate)
+        try:
+            return await asyncio.wait_for(ai_client.chat.completions.create(**kwargs), OPENAI_REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError(f"OpenAI не ответил за {OPENAI_REQUEST_TIMEOUT}с") from None
+        finally:
+            if gate is not None:
+                release_gate(gate)
+
+async def openai_chat(ai_client, call, **kwargs):
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        start = time.monotonic()
+        try:
+            return await _openai_request(ai_client, kwargs)
+        except Exception as e:
+            metric_inc("openai_errors_total", call=call)
+            if attempt == OPENAI_MAX_RETRIES or not is_retryable_openai_error(e):
+                raise
+            delay = min(60, OPENAI_RETRY_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+            metric_inc("openai_retries_total", call=call)
+            print(f"[OPENAI] {call}: {type(e).__name__}, повтор {attempt + 1} через {delay:.1f}с")
+            await asyncio.sleep(delay)
+        finally:
+            metric_observe("stage_seconds", time.monotonic() - start, stage=f"openai_{call}")
+
+def response_usage(resp):
+    # (входные, выходные, стоимость, из них взято из кеша префикса)
+    details = getattr(resp.usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    cost = resp.usage.total_tokens * 0.00000035
+    return resp.usage.prompt_tokens, resp.usage.completion_tokens, cost, cached
+
+# Ошибки запроса (5xx после повторов, таймаут, 401, insufficient_quota) не глотаются, а поднимаются
+# к prepare_comment_async: это не отказ модели, пост уходит в outbox на повтор. Пустой ответ
+# успешного запроса - отказ, его возвращаем как есть.
+
+async def describe_image(ai_client, image_url):
+    resp = await openai_chat(ai_client, "describe_image",
+        model="gpt-4o-mini",
+        messages=describe_image_messages(image_url),
+        max_tokens=300,
+    )
+    txt = (resp.choices[0].message.content or "").strip()
+    return (txt,) + response_usage(resp)
+
+async def generate_comment(ai_client, caption, image_desc):
+    resp = await openai_chat(ai_client, "generate_comment",
+        model="gpt-4o-mini",
+        messages=comment_messages(caption, image_desc),
+        max_tokens=120,
+    )
+    txt = (resp.choices[0].message.content or "").strip()
+    return (txt,) + response_usage(resp)
+
+COMMENT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "instagram_comment",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "comment": {"type": "string"},
+                "description": {"type": "string"},
+                "refused": {"type": "boolean"},
+            },
+            "required": ["comment", "description", "refused"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+async def generate_comment_multimodal(ai_client, caption, image_url):
+    # Описание и комментарий одним vision-запросом. Ответ - JSON по COMMENT_RESPONSE_FORMAT,
+    # refused=True, если модель не может разобрать изображение.
+    resp = await openai_chat(ai_client, "multimodal",
+        model="gpt-4o-mini",
+        messages=comment_multimodal_messages(caption, image_url),
+        response_format=COMMENT_RESPONSE_FORMAT,
+        max_tokens=200,
+    )
+    message = resp.choices[0].message
+    if message.refusal:
+        result = {"comment": "", "description": "", "refused": True}
+    else:
+        result = json.loads(message.content)
+    return (result,) + response_usage(resp)
 
 # ----------------------------------------------------
-# 9. OPENAI ФУНКЦИИ
+# 16. ПОДГОТОВКА ИЗОБРАЖЕНИЙ
 # ----------------------------------------------------
 
-def describe_image(ai_client, image_url):
+# Миниатюра скачивается через общую requests.Session, уменьшается до IMAGE_MAX_SIDE и уходит
+# в OpenAI как base64 data URL, поэтому OpenAI не тянет картинку сам и не считает тайлы полного размера.
+# Готовый JPEG хранится в logs/thumbnails/ и переживает перезапуск. Подготовка запускается в пуле
+# потоков сразу после отбора кандидатов и идёт, пока основной поток занят другими постами.
+# Без Pillow подготовка выключена и в OpenAI уходит исходный URL.
+
+THUMBNAIL_DIR = os.path.join(LOGS_DIR, "thumbnails")
+
+# Цена изображения для gpt-4o-mini: base за картинку + tile за каждый тайл 512px (для "low" - только base)
+VISION_TOKENS_BASE = 2833
+VISION_TOKENS_PER_TILE = 5667
+
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=IMAGE_PREPROCESS_WORKERS * 2))
+HTTP_SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=IMAGE_PREPROCESS_WORKERS * 2))
+
+IMAGE_FUTURES_LOCK = threading.Lock()
+IMAGE_FUTURES = {}  # media_id -> Future с подготовленной миниатюрой
+_image_pool = None
+
+def fetch_thumbnail(image_url):
+    with metric_timer("thumbnail"):
+        r = HTTP_SESSION.get(image_url, timeout=20)
+    r.raise_for_status()
+    return r.content
+
+def vision_tokens(width, height, detail):
+    if detail == "low":
+        return VISION_TOKENS_BASE
+    # "high" (и "auto" для больших картинок): вписываем в 2048x2048, короткую сторону - в 768
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    if min(w, h) > 768:
+        scale = 768 / min(w, h)
+        w, h = w * scale, h * scale
+    tiles = math.ceil(w / 512) * math.ceil(h / 512)
+    return VISION_TOKENS_BASE + VISION_TOKENS_PER_TILE * tiles
+
+def _image_record(data, original_size):
+    size = Image.open(io.BytesIO(data)).size
+    return {
+        "data": data,
+        "data_url": "data:image/jpeg;base64," + base64.b64encode(data).decode("ascii"),
+        # Сколько токенов стоила бы исходная миниатюра по URL (detail="auto") против отправляемой
+        "tokens_saved": max(0, vision_tokens(*original_size, "high") - vision_tokens(*size, IMAGE_DETAIL)),
+    }
+
+def prepare_image(media_id, image_url):
+    path = os.path.join(THUMBNAIL_DIR, f"{media_id}.jpg")
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        original_size = image_original_size(media_id)
+        if original_size is not None:
+            return _image_record(data, original_size)
+
+    raw = fetch_thumbnail(image_url)
+    with metric_timer("image_preprocess"):
+        img = Image.open(io.BytesIO(raw))
+        original_size = img.size
+        img = img.convert("RGB")
+        img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=IMAGE_JPEG_QUALITY)
+        data = buf.getvalue()
+
+    os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    image_store_original_size(media_id, original_size)
+    print(f"[Изображения] {media_id}: {original_size[0]}x{original_size[1]}, {len(raw)} -> {len(data)} байт")
+    return _image_record(data, original_size)
+
+def _prepare_image_safe(media_id, image_url):
     try:
-        resp = ai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Please very precisely describe this Instagram image, focusing on the style of depicting, guessing the mood, interpreting the meaning, and admitting any unique traits. If the image contains text, then scan it and include text unchanged into the description."},
-                        {"type": "image_url", "image_url": {"url": image_url}},
-                    ],
-                }
-            ],
-            max_tokens=300,
-        )
-        txt = resp.choices[0].message.content.strip()
-        total = resp.usage.total_tokens
-        cost = total * 0.00000035
-        return txt, resp.usage.prompt_tokens, resp.usage.completion_tokens, cost
+        return prepare_image(media_id, image_url)
     except Exception as e:
-        log_error(f"describe_image error: {e}")
-        return "", 0, 0, 0.0
+        print(f"[Изображения] Не удалось подготовить миниатюру {media_id}: {e}")
+        return None
+
+def prefetch_images(posts):
+    global _image_pool
+    if Image is None:
+        return
+    with IMAGE_FUTURES_LOCK:
+        if _image_pool is None:
+            _image_pool = ThreadPoolExecutor(IMAGE_PREPROCESS_WORKERS, thread_name_prefix="image")
+        for post in posts:
+            for media_id, image_url in post.images[:describe_slides_limit()]:
+                if media_id not in IMAGE_FUTURES:
+                    IMAGE_FUTURES[media_id] = _image_pool.submit(_prepare_image_safe, media_id, image_url)
+
+def get_prepared_image(media_id, image_url):
+    # None - без Pillow или при ошибке загрузки; тогда работаем по исходному URL
+    if Image is None:
+        return None
+    with IMAGE_FUTURES_LOCK:
+        future = IMAGE_FUTURES.pop(media_id, None)
+    if future is None:
+        return _prepare_image_safe(media_id, image_url)
+    with metric_timer("image_wait"):
+        return future.result()
+
+def discard_prepared_images(posts=None):
+    # Миниатюры, до которых не дошёл get_prepared_image (бюджет, пост из журнала, отказ, слайды сверх
+    # уменьшенного лимита, /drain), иначе так и держали бы JPEG и его base64 в памяти демона.
+    # posts=None - все; JPEG остаётся в logs/thumbnails/, повторная подготовка его просто прочитает
+    with IMAGE_FUTURES_LOCK:
+        if posts is None:
+            futures = list(IMAGE_FUTURES.values())
+            IMAGE_FUTURES.clear()
+        else:
+            futures = [IMAGE_FUTURES.pop(media_id, None) for post in posts for media_id, _ in post.images]
+    for future in futures:
+        if future is not None:
+            future.cancel()
+
+# ----------------------------------------------------
+# 17. КЕШ ОПИСАНИЙ ИЗОБРАЖЕНИЙ
+# ----------------------------------------------------
+
+# Описания хранятся в logs/image_desc_cache.db с ключом по dHash миниатюры
+# ("phash:<hex>"), без Pillow или при ошибке загрузки - по id медиа ("media:<id>").
+# Похожие кадры находятся по расстоянию Хэмминга, старые записи вытесняются по last_used.
+
+IMAGE_CACHE_LOCK = threading.Lock()
+IMAGE_CACHE_STATS = {"hits": 0, "misses": 0}
+_image_cache_conn = None
+
+def get_image_cache():
+    global _image_cache_conn
+    if _image_cache_conn is None:
+        conn = sqlite3.connect(os.path.join(LOGS_DIR, "image_desc_cache.db"), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS image_desc ("
+                "key TEXT PRIMARY KEY, phash TEXT, description TEXT NOT NULL, last_used INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_image_desc_last_used ON image_desc(last_used)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS thumbnails ("
+                "media_id TEXT PRIMARY KEY, width INTEGER NOT NULL, height INTEGER NOT NULL, created INTEGER NOT NULL)"
+            )
+        _image_cache_conn = conn
+    return _image_cache_conn
+
+def image_original_size(media_id):
+    with IMAGE_CACHE_LOCK:
+        row = get_image_cache().execute(
+            "SELECT width, height FROM thumbnails WHERE media_id = ?", (media_id,)
+        ).fetchone()
+    return tuple(row) if row else None
+
+def image_store_original_size(media_id, size):
+    # Заодно вытесняем самые старые миниатюры с диска, держим не больше IMAGE_CACHE_MAX_ENTRIES
+    with IMAGE_CACHE_LOCK:
+        conn = get_image_cache()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO thumbnails (media_id, width, height, created) VALUES (?, ?, ?, ?)",
+                (media_id, size[0], size[1], int(time.time()))
+            )
+            stale = [row[0] for row in conn.execute(
+                "SELECT media_id FROM thumbnails ORDER BY created DESC LIMIT -1 OFFSET ?", (IMAGE_CACHE_MAX_ENTRIES,)
+            )]
+            conn.executemany("DELETE FROM thumbnails WHERE media_id = ?", [(m,) for m in stale])
+    for media_id in stale:
+        try:
+            os.remove(os.path.join(THUMBNAIL_DIR, f"{media_id}.jpg"))
+        except OSError:
+            pass
+
+def image_dhash(data):
+    img = Image.open(io.BytesIO(data)).convert("L").resize((9, 8))
+    px = list(img.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return value
+
+def image_cache_lookup(media_id, image_data):
+    # image_data - подготовленная миниатюра или None. Возвращает (описание или None, phash или None)
+    phash = None
+    if image_data is not None:
+        try:
+            phash = image_dhash(image_data)
+            if phash in (0, 2 ** 64 - 1):
+                phash = None  # Однотонная картинка - хеш ничего не различает
+        except Exception as e:
+            print(f"[Кеш описаний] Не удалось посчитать хеш для {media_id}: {e}")
+
+    with IMAGE_CACHE_LOCK:
+        conn = get_image_cache()
+        found = None
+        if phash is not None:
+            for key, stored, desc in conn.execute("SELECT key, phash, description FROM image_desc WHERE phash IS NOT NULL"):
+                if bin(int(stored, 16) ^ phash).count("1") <= IMAGE_CACHE_MAX_DISTANCE:
+                    found = (key, desc)
+                    break
+        if found is None:
+            found = conn.execute("SELECT key, description FROM image_desc WHERE key = ?", (f"media:{media_id}",)).fetchone()
+
+        if found is None:
+            IMAGE_CACHE_STATS["misses"] += 1
+            metric_inc("image_cache_total", result="miss")
+            print(f"[Кеш описаний] Промах {media_id} (hits={IMAGE_CACHE_STATS['hits']}, misses={IMAGE_CACHE_STATS['misses']})")
+            return None, phash
+
+        with conn:
+            conn.execute("UPDATE image_desc SET last_used = ? WHERE key = ?", (int(time.time()), found[0]))
+        IMAGE_CACHE_STATS["hits"] += 1
+        metric_inc("image_cache_total", result="hit")
+        print(f"[Кеш описаний] Попадание {media_id} (hits={IMAGE_CACHE_STATS['hits']}, misses={IMAGE_CACHE_STATS['misses']})")
+        return found[1], phash
+
+def image_cache_store(media_id, phash, description):
+    key = f"phash:{phash:016x}" if phash is not None else f"media:{media_id}"
+    with IMAGE_CACHE_LOCK:
+        conn = get_image_cache()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO image_desc (key, phash, description, last_used) VALUES (?, ?, ?, ?)",
+                (key, f"{phash:016x}" if phash is not None else None, description, int(time.time()))
+            )
+            conn.execute(
+                "DELETE FROM image_desc WHERE key IN "
+                "(SELECT key FROM image_desc ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (IMAGE_CACHE_MAX_ENTRIES,)
+            )
 
-def generate_comment(ai_client, caption, image_desc):
+# ----------------------------------------------------
+# 18. ОБЩИЙ КЕШ ПОСТОВ ПОДПИСОК
+# ----------------------------------------------------
+
+# logs/media_cache.db - последние посты по pk пользователя, общий для всех сессий на этой машине.
+# Если несколько аккаунтов подписаны на одного автора, за MEDIA_CACHE_TTL user_medias запрашивает
+# только один процесс: он держит FileLock на pk, остальные ждут его и читают результат из кеша.
+# Здесь только сами посты; что прокомментировано и что пропущено, каждая сессия хранит у себя.
+
+MEDIA_CACHE_LOCK = threading.Lock()
+_media_cache_conn = None
+
+def get_media_cache():
+    global _media_cache_conn
+    if _media_cache_conn is None:
+        conn = sqlite3.connect(os.path.join(LOGS_DIR, "media_cache.db"), timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS medias ("
+                "user_pk TEXT PRIMARY KEY, amount INTEGER NOT NULL, posts TEXT NOT NULL, fetched_at REAL NOT NULL)"
+            )
+            conn.execute("DELETE FROM medias WHERE fetched_at < ?", (time.time() - 86400,))
+        _media_cache_conn = conn
+    return _media_cache_conn
+
+def media_cache_get(user_pk, amount):
+    with MEDIA_CACHE_LOCK:
+        row = get_media_cache().execute(
+            "SELECT amount, posts, fetched_at FROM medias WHERE user_pk = ?", (user_pk,)
+        ).fetchone()
+    if row is None or row[0] < amount or time.time() - row[2] > MEDIA_CACHE_TTL:
+        return None
+    return [
+        Candidate(*fields[:5], tuple(tuple(image) for image in fields[5]))
+        for fields in json.loads(row[1])
+    ][:amount]
+
+def media_cache_store(user_pk, amount, posts):
+    data = json.dumps([[p.id, p.code, p.taken_at, p.media_type, p.caption_text, p.images] for p in posts])
+    with MEDIA_CACHE_LOCK:
+        conn = get_media_cache()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO medias (user_pk, amount, posts, fetched_at) VALUES (?, ?, ?, ?)",
+                (user_pk, amount, data, time.time())
+            )
+
+def shared_user_medias(user_pk, amount, fetch):
+    # fetch() - запрос к Instagram, делается только если свежей записи нет и никто другой её сейчас не грузит
+    if MEDIA_CACHE_TTL <= 0:
+        return fetch()
+    posts = media_cache_get(user_pk, amount)
+    if posts is not None:
+        metric_inc("media_cache_total", result="hit")
+        return posts
+
+    lock = FileLock(os.path.join(LOGS_DIR, f"media_cache_{int(user_pk) % MEDIA_CACHE_LOCK_STRIPES}.lock"))
     try:
-        resp = ai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are writing comments for Instagram posts of your followings. About you: You are witty art creator Alexander. You do create engaging, narrative-rich, sometimes with humor, comments that resonate emotionally and intellectually with the audience and, importantly, complementing autor of publication and his/her post in particular."
-                },
-                {
-                    "role": "system",
-                    "content": f"'Post caption': '{caption}', 'Post Image Description (AI-estimation)': '{image_desc}', 'Comment Language': 'Equal to Post Caption language, otherwise English', 'Comment Length': 30 - 120 symbols, 'Additional Rules': 'Use \"About you\" as reference for comment styling indirectly, do not reuse info About you directly in commentaries you produce; Rarely use emojis; Never use #hashtags.'"
-                }
-            ],
-            max_tokens=120,
-        )
-        txt = resp.choices[0].message.content.strip()
-        total = resp.usage.total_tokens
-        cost = total * 0.00000035
-        return txt, resp.usage.prompt_tokens, resp.usage.completion_tokens, cost
-    except Exception as e:
-        log_error(f"generate_comment error: {e}")
-        return "", 0, 0, 0.0
+        lock.acquire(timeout=MEDIA_CACHE_LOCK_TIMEOUT)
+    except TimeoutError:
+        metric_inc("media_cache_total", result="lock_timeout")
+        print(f"[Кеш постов] Не дождались загрузки {user_pk} другим процессом, запрашиваем сами.")
+        return fetch()
+    try:
+        posts = media_cache_get(user_pk, amount)  # Пока ждали блокировку, пользователя мог загрузить другой процесс
+        if posts is not None:
+            metric_inc("media_cache_total", result="waited")
+            return posts
+        posts = fetch()
+        media_cache_store(user_pk, amount, posts)
+        metric_inc("media_cache_total", result="miss")
+        return posts
+    finally:
+        lock.release()
 
 # ----------------------------------------------------
-# 10. ЛОГИКА КОММЕНТИРОВАНИЯ ПОДПИСОК
+# 19. ЛОГИКА КОММЕНТИРОВАНИЯ ПОДПИСОК
 # ----------------------------------------------------
 
-def default_serializer(obj):
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    elif isinstance(obj, Url):
-        return str(obj)
-    return str(obj)
+# Кандидат на комментарий - только нужные поля поста. Строится напрямую из Media
+# или из сырого JSON приватного API (лента), без model_dump и полной pydantic-модели.
+# images - что можно описать: (id, url миниатюры) фото, обложки видео или каждого слайда альбома.
+
+class Candidate:
+    __slots__ = ("id", "code", "taken_at", "media_type", "caption_text", "images")
 
-def handle_rate_limit():
-    send_telegram_message("Rate limit hit. Sleeping for 3 hours...")
-    time.sleep(RATE_LIMIT_SLEEP)
+    def __init__(self, id, code, taken_at, media_type, caption_text, images):
+        self.id = id
+        self.code = code
+        self.taken_at = taken_at  # unix ts
+        self.media_type = media_type
+        self.caption_text = caption_text
+        self.images = images
 
-def can_comment(post_data):
-    post_type = post_data.get("media_type")
-    description = post_data.get("caption_text", "")
+def candidate_from_media(media):
+    if media.media_type == 8:
+        images = tuple((str(r.pk), str(r.thumbnail_url)) for r in media.resources if r.thumbnail_url)
+    else:
+        images = ((media.id, str(media.thumbnail_url)),) if media.thumbnail_url else ()
+    return Candidate(
+        media.id, media.code, media.taken_at.timestamp(), media.media_type, media.caption_text or "", images
+    )
+
+def _raw_thumbnail_url(data):
+    return ((data.get("image_versions2") or {}).get("candidates") or [{}])[0].get("url", "")
+
+def candidate_from_raw(data):
+    if data.get("carousel_media"):
+        images = tuple(
+            (str(item.get("id") or item.get("pk")), _raw_thumbnail_url(item))
+            for item in data["carousel_media"] if _raw_thumbnail_url(item)
+        )
+    else:
+        images = ((data["id"], _raw_thumbnail_url(data)),) if _raw_thumbnail_url(data) else ()
+    return Candidate(
+        data["id"], data.get("code", ""), float(data.get("taken_at", 0)), data.get("media_type"),
+        (data.get("caption") or {}).get("text", ""), images
+    )
+
+def candidate_from_journal(entry):
+    return Candidate(
+        entry["media_id"], entry["code"], entry["taken_at"], entry["media_type"], entry["caption"] or "",
+        tuple(tuple(image) for image in json.loads(entry["images"] or "[]"))
+    )
+
+def can_comment(post):
+    post_type = post.media_type
+    description = post.caption_text
 
     if post_type not in POST_TYPES_FOR_COMMENTING:
+        metric_inc("posts_skipped_total", reason="type")
         print(f"[Комментирование Подписок] Тип поста {post_type} не разрешён для комментирования. Пропускаем.")
         return False
 
-    if post_type != 1 and len(description) < THRESHOLD_LENGTH_FOR_COMMENTING:
+    if not post.images and len(description) < THRESHOLD_LENGTH_FOR_COMMENTING:
+        metric_inc("posts_skipped_total", reason="short_caption")
         print(f"[Комментирование Подписок] Описание поста слишком короткое (менее {THRESHOLD_LENGTH_FOR_COMMENTING} символов), пропускаем.")
         return False
 
     return True
 
-def random_delay(min_s, max_s):
+def random_delay(min_s, max_s, stage="sleep"):
     delay = random.uniform(min_s, max_s)
     print(f"Sleeping {delay:.1f}s...")
-    time.sleep(delay)
+    with metric_timer(stage):
+        time.sleep(delay)
 
 def post_comment(cl, post_id, text):
     try:
-        cl.media_comment(post_id, text)
-        cl.media_like(post_id)
-        return True
+        rate_limited_call("comment", cl.media_comment, post_id, text)
     except Exception as e:
         log_error(f"Failed to post comment: {e}")
+        journal_failed(post_id, f"media_comment: {e}")
         return False
+    journal_advance(post_id, "posted")
+    return True
 
-def logic_comment_followings(cl, config, ai_client):
-    session_path = config['Session']['path']
-    username = config['Instagram']['ig_username']
+def like_post(cl, post_id):
+    try:
+        rate_limited_call("like", cl.media_like, post_id)
+    except Exception as e:
+        log_error(f"Failed to like post: {e}")
+        metric_inc("likes_total", result="failed")
+        journal_failed(post_id, f"media_like: {e}", like=True)
+        return False
+    metric_inc("likes_total", result="liked")
+    journal_advance(post_id, "posted", liked=1)
+    return True
 
-    os.makedirs("sessions", exist_ok=True)
-    os.makedirs("logs", exist_ok=True)
+# Подписки синхронизируются постранично (свежие подписки идут первыми) прямо в очередь.
+# При обычном старте листаем, пока страница не упрётся в уже известных пользователей.
+# Полная сверка с удалением отписок идёт в фоне раз в FOLLOWINGS_FULL_SYNC_HOURS.
+
+def following_page_latest(cl, max_id):
+    # user_following_v1_chunk ранжирует список (search_surface=follow_list_page) без порядка по дате,
+    # поэтому для инкрементальной синхронизации просим страницы с последними подписками сверху
+    from instagrapi.extractors import extract_user_short
+    params = {"count": FOLLOWINGS_PAGE_SIZE, "rank_token": cl.rank_token, "order": "date_followed_latest"}
+    if max_id:
+        params["max_id"] = max_id
+    result = cl.private_request(f"friendships/{cl.user_id}/following/", params=params)
+    return [extract_user_short(u) for u in result.get("users", [])], result.get("next_max_id") or ""
+
+def fetch_followings_page(cl, session_path, cursor, latest=False):
+    # session_path=None - без пересоздания сессии, ошибка пробрасывается (фоновая сверка)
+    while True:
+        try:
+            if latest:
+                return rate_limited_call("following", following_page_latest, cl, cursor)
+            return rate_limited_call(
+                "following", cl.user_following_v1_chunk, str(cl.user_id),
+                max_amount=FOLLOWINGS_PAGE_SIZE, max_id=cursor
+            )
+        except Exception as e:
+            if is_rate_limit_error(e):
+                continue  # Пауза уже назначена в rate_limited_call
+            if session_path is None:
+                raise
+            log_error(f"[Комментирование Подписок] Ошибка user_following: {e}, пересоздаём сессию.")
+            recreate_session(cl, session_path)
+            continue
+
+def incremental_sync_followings(cl, queue, session_path):
+    # Страницы идут от последних подписок к старым: как только на странице есть уже известный
+    # пользователь, дальше новых нет
+    cursor = ""
+    added_total, pages = 0, 0
+    while True:
+        users, cursor = fetch_followings_page(cl, session_path, cursor, latest=True)
+        pages += 1
+        added = queue_merge(queue, [(u.username, str(u.pk)) for u in users])
+        added_total += added
+        if added < len(users) or not cursor:
+            break
+    print(f"[Комментирование Подписок] Инкрементальная синхронизация: страниц {pages}, новых подписок {added_total}.")
+    return added_total
+
+FULL_SYNC_LOCK = threading.Lock()  # Одна полная сверка на процесс: проход демона не запускает вторую поверх долгой
+
+def full_sync_followings(cl, username, session_path=None):
+    # Отдельное соединение: сверка может идти в фоне параллельно с основным проходом
+    if not FULL_SYNC_LOCK.acquire(blocking=False):
+        print("[Комментирование Подписок] Полная синхронизация уже идёт, пропускаем.")
+        return
+    conn = open_followings_queue(username)
+    try:
+        sync_id = int(queue_get_meta(conn, "sync_id", 0)) + 1
+        queue_set_meta(conn, "sync_id", sync_id)
+        cursor = ""
+        seen, added_total = 0, 0
+        while True:
+            users, cursor = fetch_followings_page(cl, session_path, cursor)
+            added_total += queue_merge(conn, [(u.username, str(u.pk)) for u in users])
+            queue_mark_seen(conn, [str(u.pk) for u in users], sync_id)
+            seen += len(users)
+            if not cursor:
+                break
+        removed = queue_remove_unseen(conn, sync_id) if seen else 0
+        queue_set_meta(conn, "last_full_sync", int(time.time()))
+        print(f"[Комментирование Подписок] Полная синхронизация: подписок {seen}, новых {added_total}, отписок {removed}.")
+    finally:
+        conn.close()
+        FULL_SYNC_LOCK.release()
 
-    followings_file = os.path.join(LOGS_DIR, f"{username}_followings.txt")
+def start_background_full_sync(cl, username):
+    if FULL_SYNC_LOCK.locked():
+        return  # Прошлая сверка ещё идёт (например, ждёт паузу после 429)
 
+    def run():
+        try:
+            full_sync_followings(cl, username)
+        except Exception as e:
+            log_error(f"[Комментирование Подписок] Фоновая синхронизация подписок не удалась: {e}")
+
+    threading.Thread(target=run, name="followings-sync", daemon=True).start()
+
+def fetch_user_posts(cl, queue, session_path, user):
+    # (все последние посты пользователя (Candidate), его текущее имя), через общий для сессий кеш.
+    # Удалённый аккаунт убирается из очереди; после USER_FETCH_MAX_ATTEMPTS неудач ошибка уходит
+    # в handle_user_error, и пользователь переносится в конец очереди
+    attempts = 0
     while True:
         try:
-            print("[Комментирование Подписок] Запрос user_following...")
-            followings = cl.user_following(cl.user_id, amount=0)
-            print(f"[Комментирование Подписок] Получено {len(followings)} подписок.")
-            break
-        except PleaseWaitFewMinutes:
-            send_telegram_message("[Комментирование Подписок] PleaseWaitFewMinutes при user_following, спим 3 мин.")
-            time.sleep(WAIT_FEW_MINUTES_SLEEP)
+            user_id, user = resolve_user_pk(cl, queue, user)
+
+            def fetch():
+                medias = rate_limited_call("medias", cl.user_medias, user_id, amount=SUBSCRIPTIONS_POSTS_AMOUNT)
+                return [candidate_from_media(media) for media in medias]
+
+            posts = shared_user_medias(str(user_id), SUBSCRIPTIONS_POSTS_AMOUNT, fetch)
+            print(f"[Комментирование Подписок] У пользователя {user} получено {len(posts)} постов.")
+            return posts, user
+        except Exception as e2:
+            if is_user_not_found_error(e2):
+                print(f"[Комментирование Подписок] Пользователь {user} не найден, убираем из очереди.")
+                queue_remove(queue, user)
+                return [], user
+            attempts += 1
+            if attempts >= USER_FETCH_MAX_ATTEMPTS:
+                raise
+            if is_rate_limit_error(e2):
+                continue  # Пауза уже назначена в rate_limited_call
+            log_error(f"[Комментирование Подписок] Ошибка user_medias: {e2}, пересоздаём сессию.")
+            recreate_session(cl, session_path)
             continue
-        except Exception as e:
-            if "429" in str(e):
-                print("[Комментирование Подписок] 429 при followings. Спим...")
-                for mins in SLEEP_INTERVALS:
-                    print(f"Сон {mins} минут...")
-                    time.sleep(mins * 60)
+
+# Лента: свежие посты всех подписок за несколько запросов. Листаем, пока на странице есть посты
+# моложе POST_CUTOFF_HOURS (лента ранжированная, поэтому смотрим на всю страницу, а не на последний пост).
+# Реклама и рекомендации от неподписанных аккаунтов отбрасываются.
+
+def fetch_timeline_posts(cl, queue):
+    cutoff_ts = time.time() - POST_CUTOFF_HOURS * 3600
+    by_user = {}
+    max_id = None
+    for page in range(TIMELINE_MAX_PAGES):
+        while True:
+            try:
+                feed = rate_limited_call(
+                    "timeline", cl.get_timeline_feed,
+                    reason="pagination" if max_id else "pull_to_refresh", max_id=max_id
+                )
+                break
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    continue  # Пауза уже назначена в rate_limited_call
+                raise
+
+        fresh = 0
+        for item in feed.get("feed_items", []):
+            media = item.get("media_or_ad")
+            if not media or media.get("injected") or media.get("ad_id"):
                 continue
-            log_error(f"[Комментирование Подписок] Ошибка user_following: {e}, пересоздаём сессию.")
-            remove_and_recreate_session(cl, session_path)
+            if media.get("taken_at", 0) < cutoff_ts:
+                continue
+            fresh += 1
+            username = queue_username_by_pk(queue, str(media.get("user", {}).get("pk", "")))
+            if username is None:
+                metric_inc("posts_skipped_total", reason="not_following")
+                continue
+            by_user.setdefault(username, []).append(candidate_from_raw(media))
+
+        max_id = feed.get("next_max_id")
+        if not fresh or not feed.get("more_available") or not max_id:
+            break
+    posts_total = sum(len(v) for v in by_user.values())
+    print(f"[Лента] Страниц {page + 1}, свежих постов подписок {posts_total} от {len(by_user)} пользователей.")
+    return by_user
+
+def fresh_posts(posts):
+    cutoff_ts = time.time() - POST_CUTOFF_HOURS * 3600
+    fresh = []
+    for post in posts:
+        if post.taken_at < cutoff_ts:
+            metric_inc("posts_skipped_total", reason="old")
+            print(f"[Комментирование Подписок] Пост {post.id} старше {POST_CUTOFF_HOURS}ч, пропускаем.")
             continue
+        fresh.append(post)
+    return fresh
 
-    follow_list = [u.username for u in followings.values()]
+def select_candidates(posts, commented_index):
+    candidates = []
 
-    if not os.path.exists(followings_file):
-        with open(followings_file, 'w') as f:
-            for user in follow_list:
-                f.write(f"{user}\n")
+    for post in posts:
+        if is_commented(commented_index, post.id):
+            metric_inc("posts_skipped_total", reason="commented")
+            print(f"[Комментирование Подписок] Пост {post.id} уже прокомментирован, пропускаем.")
+            continue
+
+        if not can_comment(post):
+            print(f"[Комментирование Подписок] Пост {post.id} пропущен по типу или длине описания.")
+            continue
+
+        candidates.append(post)
+    return candidates
+
+def is_refusal(desc):
+    return any(x in desc.lower() for x in ["i'm sorry", "i am sorry", "i can't", "i can not"])
+
+def prepare_comment(ai_client, config, post):
+    return run_ai(prepare_comment_async(ai_client, config, post))
+
+async def prepare_comment_async(ai_client, config, post):
+    with metric_timer("prepare_comment"):
+        try:
+            return await _prepare_comment(ai_client, config, post)
+        except Exception as e:
+            # Сбой OpenAI (или подготовки) - не отказ: пост повторяется из outbox с паузой
+            metric_inc("posts_skipped_total", reason="openai_error")
+            log_error(f"[Комментирование Подписок] Не удалось подготовить комментарий {post.id}: {e}")
+            journal_failed(post.id, f"openai: {e}")
+            return None
+        finally:
+            discard_prepared_images([post])
+
+# Фото и обложка видео описываются одним запросом. Слайды альбома описываются параллельно
+# (не больше DESCRIBE_WORKERS одновременно); слайдов берётся столько, сколько помещается в POST_TOKEN_BUDGET,
+# а всё, что не успело за POST_DESCRIBE_TIMEOUT, отменяется. Поэтому время на пост не растёт с числом слайдов.
+
+def describe_slides_limit():
+    side = IMAGE_MAX_SIDE if Image is not None else 1080
+    per_slide = vision_tokens(side, side, IMAGE_DETAIL) + 400  # + текст запроса и ответ до 300 токенов
+    return max(1, min(CAROUSEL_MAX_RESOURCES, POST_TOKEN_BUDGET // per_slide))
+
+async def describe_resource(ai_client, config, media_id, image_url):
+    # Возвращает (описание или None при отказе, токены, стоимость); ошибка запроса поднимается выше
+    image = await asyncio.to_thread(get_prepared_image, media_id, image_url)
+    cached_desc, phash = await asyncio.to_thread(image_cache_lookup, media_id, image["data"] if image else None)
+    if cached_desc is not None:
+        return cached_desc, 0, 0.0
+
+    desc, in1, out1, cost1, cached1 = await describe_image(ai_client, image["data_url"] if image else image_url)
+    print(f"[Комментирование Подписок] describe_image {media_id} => {desc[:60]}...")
+    add_openai_usage(config, in1, out1, cost1, cached1, image["tokens_saved"] if image else 0)
+    if not desc or is_refusal(desc):
+        return None, in1 + out1, cost1
+    await asyncio.to_thread(image_cache_store, media_id, phash, desc)
+    return desc, in1 + out1, cost1
+
+async def describe_post_images(ai_client, config, images):
+    # Возвращает (текст для generate_comment или None, токены, стоимость)
+    if len(images) == 1:
+        results = [await describe_resource(ai_client, config, *images[0])]
     else:
-        with open(followings_file, 'r') as f:
-            existing = [x.strip() for x in f]
-        new_users = [u for u in follow_list if u not in existing]
-        final_list = new_users + existing
-        with open(followings_file, 'w') as f:
-            for u in final_list:
-                f.write(f"{u}\n")
-
-    with open(followings_file, 'r') as f:
-        final_list = [x.strip() for x in f.readlines()]
-
-    commented_log = "commented.txt"
-    if not os.path.exists(commented_log):
-        open(commented_log, 'w').close()
-
-    idx = 0
-    while idx < len(final_list):
-        user = final_list[idx]
+        slots = asyncio.Semaphore(DESCRIBE_WORKERS)
+
+        async def describe_slide(image):
+            async with slots:
+                return await describe_resource(ai_client, config, *image)
+
+        tasks = [asyncio.ensure_future(describe_slide(image)) for image in images]
+        with metric_timer("describe_slides"):
+            done, not_done = await asyncio.wait(tasks, timeout=POST_DESCRIBE_TIMEOUT)
+        for task in not_done:
+            task.cancel()
+        if not_done:
+            metric_inc("slides_timed_out_total", len(not_done))
+            print(f"[Комментирование Подписок] {len(not_done)} слайдов не описаны за {POST_DESCRIBE_TIMEOUT}с.")
+        errors = [task.exception() for task in tasks if task in done and task.exception() is not None]
+        if errors:
+            raise errors[0]  # Описанные слайды уже в кеше описаний, повтор их не оплачивает
+        results = [task.result() if task in done else (None, 0, 0.0) for task in tasks]
+
+    tokens = sum(r[1] for r in results)
+    cost = sum(r[2] for r in results)
+    described = [(i, r[0]) for i, r in enumerate(results) if r[0]]
+    if not described:
+        return None, tokens, cost
+    if len(images) == 1:
+        return described[0][1], tokens, cost
+    return "\n".join(f"Slide {i + 1}/{len(images)}: {desc}" for i, desc in described), tokens, cost
+
+async def _prepare_comment(ai_client, config, post):
+    # Отказ модели или пустой комментарий - пост пропускается насовсем, а не комментируется "вслепую".
+    # Стадии, уже записанные в журнал, не повторяются.
+    metric_inc("candidates_total")
+    entry = journal_get(post.id)
+    if entry is not None and entry["comment"]:
+        print(f"[Журнал] {post.id}: комментарий уже сгенерирован, берём из журнала.")
+        return {
+            "post": post,
+            "comment": entry["comment"],
+            "description": entry["description"] or "",
+            "tokens": entry["tokens"],
+            "cost": entry["cost"],
+        }
+
+    if openai_budget_exceeded():
+        # Бюджет - на запуск супервизора: пост остаётся недоделанным в журнале и следующий запуск
+        # допубликует его из outbox
+        metric_inc("posts_skipped_total", reason="budget")
+        print("[Комментирование Подписок] Бюджет OpenAI супервизора исчерпан, пропускаем.")
+        return None
+
+    images = post.images[:describe_slides_limit()]
+    recognition_text, tokens1, cost1 = "", 0, 0.0
+
+    if entry is not None and entry["state"] == "described":
+        print(f"[Журнал] {post.id}: описание уже есть, берём из журнала.")
+        recognition_text, tokens1, cost1 = entry["description"] or "", entry["tokens"], entry["cost"]
+    elif COMMENT_MODE == "single_call" and len(images) == 1:
+        media_id, image_url = images[0]
+        image = await asyncio.to_thread(get_prepared_image, media_id, image_url)
+        cached_desc, phash = await asyncio.to_thread(image_cache_lookup, media_id, image["data"] if image else None)
+        if cached_desc is None:
+            result, in1, out1, cost1, cached1 = await generate_comment_multimodal(
+                ai_client, post.caption_text, image["data_url"] if image else image_url
+            )
+            add_openai_usage(config, in1, out1, cost1, cached1, image["tokens_saved"] if image else 0)
+            if result["refused"] or not result["comment"].strip():
+                metric_inc("posts_skipped_total", reason="refusal")
+                journal_advance(post.id, "skipped", last_error="refusal")
+                print("[Комментирование Подписок] OpenAI не смог прокомментировать изображение, пропускаем.")
+                return None
+            com = result["comment"].strip()
+            print(f"[Комментирование Подписок] => Comment (single_call): {com[:60]}...")
+            journal_advance(post.id, "generated", description=result["description"], comment=com,
+                            tokens=in1 + out1, cost=cost1)
+            if result["description"]:
+                await asyncio.to_thread(image_cache_store, media_id, phash, result["description"])
+            return {
+                "post": post,
+                "comment": com,
+                "description": result["description"],
+                "tokens": in1 + out1,
+                "cost": cost1,
+            }
+        recognition_text = cached_desc
+    elif images:
+        recognition_text, tokens1, cost1 = await describe_post_images(ai_client, config, images)
+        if recognition_text is None:
+            metric_inc("posts_skipped_total", reason="refusal")
+            journal_advance(post.id, "skipped", last_error="refusal")
+            print("[Комментирование Подписки] OpenAI не смог описать изображение, пропускаем.")
+            return None
+
+    if entry is None or entry["state"] != "described":
+        journal_advance(post.id, "described", description=recognition_text, tokens=tokens1, cost=cost1)
+
+    com, in2, out2, cost2, cached2 = await generate_comment(ai_client, post.caption_text, recognition_text)
+    add_openai_usage(config, in2, out2, cost2, cached2)
+    if not com.strip():
+        metric_inc("posts_skipped_total", reason="empty_comment")
+        journal_advance(post.id, "skipped", last_error="empty_comment")
+        print("[Комментирование Подписок] OpenAI не вернул комментарий, пропускаем.")
+        return None
+    print(f"[Комментирование Подписок] => Comment: {com[:60]}...")
+    journal_advance(post.id, "generated", comment=com, tokens=tokens1 + in2 + out2, cost=cost1 + cost2)
+
+    return {
+        "post": post,
+        "comment": com,
+        "description": recognition_text,
+        "tokens": tokens1 + (in2 + out2),
+        "cost": cost1 + cost2,
+    }
+
+def publish_comment(cl, commented_index, user, prepared):
+    # В commented.txt пост попадает до публикации и больше не находится поиском; при ошибке
+    # его допубликует outbox из журнала
+    post = prepared["post"]
+    com = prepared["comment"]
+    if not is_commented(commented_index, post.id):
+        mark_commented(commented_index, post.id)
+
+    if not post_comment(cl, post.id, com):
+        metric_inc("comments_total", result="failed")
+        return False
+    like_post(cl, post.id)
+
+    print(f"[Комментирование Подписок] Успешно прокомментировали {post.id}")
+    metric_inc("comments_total", result="posted")
+    WORKER_COUNTERS["comments"] += 1
+    report_status(comments=WORKER_COUNTERS["comments"], last_comment=int(time.time()))
+    msg = (
+        f"Комментирование Подписок\n\n"
+        f"User: {user}\n\n"
+        f"Post: https://instagram.com/p/{post.code}\n\n"
+        f"Caption: {post.caption_text}\n\n"
+        f"Image desc: {prepared['description']}\n\n"
+        f"-----------------------------------------\n\n"
+        f"Comment: {com}\n\n"
+        f"Tokens used: {prepared['tokens']}, cost={prepared['cost']:.8f}\n"
+    )
+    send_telegram_message(msg)
+    return True
+
+def handle_user_error(queue, user, e):
+    err_str = f"[Комментирование Подписок] Error processing {user}: {e}"
+    print(err_str)
+    send_telegram_message(err_str)
+    queue_rotate(queue, user)  # Пауза после 429 уже назначена в rate_limited_call
+
+def discover_user(cl, queue, session_path, commented_index, user, prefetched):
+    # (текущее имя пользователя, кандидаты). Имя может смениться: переименование находит resolve_user_pk,
+    # и дальше в очереди пользователь ищется уже по новому имени.
+    # prefetched - свежие посты из ленты {username: [Candidate]}; None - запрашиваем user_medias
+    WORKER_COUNTERS["users"] += 1
+    metric_inc("users_processed_total")
+    report_status(user=user, users=WORKER_COUNTERS["users"])
+    # Пользователь, запрошенный через API демона, может отсутствовать в ленте - тогда user_medias
+    from_timeline = prefetched is not None and user in prefetched
+    if from_timeline:
+        posts = prefetched[user]
+    else:
+        posts, user = fetch_user_posts(cl, queue, session_path, user)
+    queue_record_activity(queue, user, [p.taken_at for p in posts])
+    if not from_timeline:
+        posts = fresh_posts(posts)
+    candidates = []
+    for post in select_candidates(posts, commented_index):
+        if journal_discovered(user, post):
+            candidates.append(post)
+        else:
+            metric_inc("posts_skipped_total", reason="journal")
+    prefetch_images(candidates)
+    return user, candidates
+
+def drain_outbox(cl, config, ai_client, commented_index):
+    # Допубликовываем посты из журнала (после падения или ошибки media_comment) и ставим недостающие лайки.
+    # Готовый комментарий берётся из журнала, OpenAI вызывается только для недоделанных стадий.
+    entries = journal_due()
+    if not entries:
+        return
+    print(f"[Журнал] В outbox {len(entries)} постов.")
+    for entry in entries:
+        if not daemon_wait():
+            return
+        post = candidate_from_journal(entry)
+        try:
+            if entry["state"] == "posted":
+                like_post(cl, post.id)
+                continue
+            if time.time() - post.taken_at > OUTBOX_MAX_AGE_HOURS * 3600:
+                print(f"[Журнал] {post.id} старше {OUTBOX_MAX_AGE_HOURS}ч, бросаем.")
+                journal_advance(post.id, "abandoned")
+                continue
+            prepared = prepare_comment(ai_client, config, post)
+            if prepared is not None and publish_comment(cl, commented_index, entry["user"], prepared):
+                random_delay(RANDOM_DELAY_MIN_BETWEEN_COMMENTS, RANDOM_DELAY_MAX_BETWEEN_COMMENTS, "sleep_comments")
+        except Exception as e:
+            log_error(f"[Журнал] Ошибка при обработке {post.id} из outbox: {e}")
+            journal_failed(post.id, e)
+
+def delay_between_users(prefetched):
+    if prefetched is None:
+        random_delay(RANDOM_DELAY_MIN_BETWEEN_USERS, RANDOM_DELAY_MAX_BETWEEN_USERS, "sleep_users")
+
+def run_sequential(cl, config, ai_client, queue, commented_index, final_list, prefetched=None):
+    session_path = config['Session']['path']
+    for user in daemon_users(final_list):
         try:
             print(f"[Комментирование Подписок] --- User={user}")
-            while True:
-                try:
-                    user_id = cl.user_id_from_username(user)
-                    posts = cl.user_medias(user_id, amount=SUBSCRIPTIONS_POSTS_AMOUNT)
-                    print(f"[Комментирование Подписок] У пользователя {user} получено {len(posts)} постов.")
-                    break
-                except PleaseWaitFewMinutes:
-                    send_telegram_message("PleaseWaitFewMinutes при user_medias. Спим 3 минуты.")
-                    time.sleep(WAIT_FEW_MINUTES_SLEEP)
-                    continue
-                except Exception as e2:
-                    if "429" in str(e2):
-                        print("[Комментирование Подписок] 429 при user_medias. Спим...")
-                        for mins in SLEEP_INTERVALS:
-                            print(f"Сон {mins} мин...")
-                            time.sleep(mins * 60)
-                        continue
-                    log_error(f"[Комментирование Подписок] Ошибка user_medias: {e2}, пересоздаём сессию.")
-                    remove_and_recreate_session(cl, session_path)
+            user, candidates = discover_user(cl, queue, session_path, commented_index, user, prefetched)
+            for post in candidates:
+                prepared = prepare_comment(ai_client, config, post)
+                if prepared is None:
                     continue
+                if not daemon_wait():
+                    break  # /drain: комментарий остаётся в журнале и уйдёт из outbox при следующем запуске
+                if publish_comment(cl, commented_index, user, prepared):
+                    random_delay(RANDOM_DELAY_MIN_BETWEEN_COMMENTS, RANDOM_DELAY_MAX_BETWEEN_COMMENTS, "sleep_comments")
 
-            now_ts = datetime.now().timestamp()
-            processed_any_post = False
+            queue_rotate(queue, user)
+            print(f"[Комментирование Подписок] Пользователь {user} перенесен в конец списка followings.")
 
-            for p in posts:
-                p_json = json.loads(json.dumps(p.model_dump(), default=default_serializer, ensure_ascii=False))
-                post_ts = datetime.fromisoformat(p_json["taken_at"]).timestamp()
+        except Exception as e:
+            handle_user_error(queue, user, e)
 
-                if (now_ts - post_ts) > (POST_CUTOFF_HOURS * 3600):
-                    print(f"[Комментирование Подписок] Пост {p_json['id']} старше {POST_CUTOFF_HOURS}ч, пропускаем.")
-                    continue
+        delay_between_users(prefetched)
 
-                if not can_comment(p_json):
-                    print(f"[Комментирование Подписок] Пост {p_json['id']} пропущен по типу или длине описания.")
-                    continue
+# Конвейер: поиск -> OpenAI -> публикация.
+# Поиск и генерация работают в фоновых потоках и заполняют ограниченные очереди,
+# пока основной поток публикует комментарии с паузами RANDOM_DELAY_*_BETWEEN_COMMENTS.
+# Конец прохода передаётся по очередям значением None.
 
-                recognition_text = ""
-                in1, out1, cost1 = 0, 0, 0.0
-
-                if p_json["media_type"] == 1:
-                    desc, in1, out1, cost1 = describe_image(ai_client, p_json["thumbnail_url"])
-                    print(f"[Комментирование Подписок] describe_image => {desc[:60]}...")
-                    if any(x in desc.lower() for x in ["i'm sorry", "i am sorry", "i can't", "i can not"]):
-                        print("[Комментирование Подписки] OpenAI не смог описать изображение, пропускаем.")
-                        continue
-                    recognition_text = desc
-                    add_openai_usage(config, in1, out1, cost1)
-                    save_config(session_path, config)
-
-                com, in2, out2, cost2 = generate_comment(ai_client, p_json["caption_text"], recognition_text)
-                print(f"[Комментирование Подписок] => Comment: {com[:60]}...")
-                add_openai_usage(config, in2, out2, cost2)
-                save_config(session_path, config)
-
-                with open(commented_log, 'a') as cfile:
-                    cfile.write(f"{p_json['id']}\n")
-
-                if post_comment(cl, p_json["id"], com):
-                    print(f"[Комментирование Подписок] Успешно прокомментировали {p_json['id']}")
-
-                    total_tokens = (in1 + out1) + (in2 + out2)
-                    total_cost = cost1 + cost2
-                    msg = (
-                        f"Комментирование Подписок\n\n"
-                        f"User: {user}\n\n"
-                        f"Post: https://instagram.com/p/{p_json['code']}\n\n"
-                        f"Caption: {p_json['caption_text']}\n\n"
-                        f"Image desc: {recognition_text}\n\n"
-                        f"-----------------------------------------\n\n"
-                        f"Comment: {com}\n\n"
-                        f"Tokens used: {total_tokens}, cost={total_cost:.8f}\n"
-                    )
-                    send_telegram_message(msg)
+def discovery_stage(cl, config, queue, commented_index, final_list, prefetched, found_q):
+    session_path = config['Session']['path']
+    try:
+        for user in daemon_users(final_list):
+            try:
+                print(f"[Конвейер: поиск] --- User={user}")
+                user, candidates = discover_user(cl, queue, session_path, commented_index, user, prefetched)
+                if candidates:
+                    found_q.put((user, candidates))
+                queue_rotate(queue, user)
+                print(f"[Конвейер: поиск] Пользователь {user} перенесен в конец списка followings.")
+            except Exception as e:
+                handle_user_error(queue, user, e)
+            delay_between_users(prefetched)
+    finally:
+        found_q.put(None)
 
-                    processed_any_post = True
-                    random_delay(RANDOM_DELAY_MIN_BETWEEN_COMMENTS, RANDOM_DELAY_MAX_BETWEEN_COMMENTS)
+def ai_stage(ai_client, config, found_q, ready_q):
+    try:
+        run_ai(ai_stage_async(ai_client, config, found_q, ready_q))
+    finally:
+        ready_q.put(None)
 
-            with open(followings_file, 'r') as f:
-                lines = [x.strip() for x in f if x.strip() != user]
-            lines.append(user)
-            with open(followings_file, 'w') as f:
-                for line_ in lines:
-                    f.write(line_ + "\n")
-            print(f"[Комментирование Подписок] Пользователь {user} перенесен в конец списка followings.")
+async def ai_stage_async(ai_client, config, found_q, ready_q):
+    # Кандидаты готовятся параллельно, не больше OPENAI_MAX_IN_FLIGHT постов одновременно.
+    # Блокирующие очереди конвейера ждём в пуле потоков, чтобы не держать event loop.
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(OPENAI_MAX_IN_FLIGHT)
+    tasks = set()
 
+    async def prepare(user, post):
+        try:
+            prepared = await prepare_comment_async(ai_client, config, post)
+            if prepared is not None:
+                await loop.run_in_executor(None, ready_q.put, (user, prepared))
         except Exception as e:
-            err_str = f"[Комментирование Подписок] Error processing {user}: {e}"
-            print(err_str)
-            send_telegram_message(err_str)
-            if "429" in str(e) or "rate limit" in str(e).lower():
-                handle_rate_limit()
+            log_error(f"[Конвейер: OpenAI] Ошибка подготовки комментария {post.id}: {e}")
+        finally:
+            slots.release()
+
+    while True:
+        item = await loop.run_in_executor(None, found_q.get)
+        if item is None:
+            break
+        user, candidates = item
+        for post in candidates:
+            await slots.acquire()
+            task = asyncio.ensure_future(prepare(user, post))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+
+def run_pipeline(cl, config, ai_client, queue, commented_index, final_list, prefetched=None):
+    global _session_owner
+    session_path = config['Session']['path']
+    found_q = queue_mod.Queue(maxsize=PIPELINE_PREFETCH_USERS)
+    ready_q = queue_mod.Queue(maxsize=PIPELINE_READY_COMMENTS)
+    _session_owner = (threading.current_thread(), ready_q)
+
+    workers = [
+        threading.Thread(target=discovery_stage, name="discovery",
+                         args=(cl, config, queue, commented_index, final_list, prefetched, found_q), daemon=True),
+        threading.Thread(target=ai_stage, name="ai",
+                         args=(ai_client, config, found_q, ready_q), daemon=True),
+    ]
+    for w in workers:
+        w.start()
+
+    try:
+        publish_ready(cl, session_path, commented_index, ready_q)
+    finally:
+        _session_owner = None
+
+    for w in workers:
+        w.join()
+
+def publish_ready(cl, session_path, commented_index, ready_q):
+    while True:
+        with metric_timer("pipeline_wait"):
+            item = ready_q.get()
+        if item is None:
+            break
+        if item[0] is SESSION_RECREATE:
+            serve_session_request(cl, session_path, item[1])
+            continue
+        user, prepared = item
+        if not daemon_wait():
+            continue  # /drain: комментарий остаётся в журнале и уйдёт из outbox при следующем запуске
+        if publish_comment(cl, commented_index, user, prepared):
+            random_delay(RANDOM_DELAY_MIN_BETWEEN_COMMENTS, RANDOM_DELAY_MAX_BETWEEN_COMMENTS, "sleep_comments")
+
+def logic_comment_followings(cl, config, ai_client, users=None, commented_index=None):
+    # users - обработать только этих пользователей, без синхронизации подписок (запросы к API демона).
+    # commented_index - уже открытые индекс и журнал (демон открывает их один раз на всё время работы)
+    session_path = config['Session']['path']
+
+    os.makedirs("sessions", exist_ok=True)
+    os.makedirs("logs", exist_ok=True)
+
+    if commented_index is not None:
+        comment_followings_pass(cl, config, ai_client, users, commented_index)
+        return
+    commented_index = open_commented_index(session_path)
+    try:
+        open_journal(session_path)
+        comment_followings_pass(cl, config, ai_client, users, commented_index)
+    finally:
+        close_journal()
+        close_commented_index(commented_index)
+
+def comment_followings_pass(cl, config, ai_client, users, commented_index):
+    session_path = config['Session']['path']
+    username = config['Instagram']['ig_username']
+
+    queue = open_followings_queue(username)
+    try:
+        if users is not None:
+            daemon_set_plan(users, queue_size(queue))
+            run_sequential(cl, config, ai_client, queue, commented_index, users)
+            return
+
+        last_full_sync = int(queue_get_meta(queue, "last_full_sync", 0))
+        if last_full_sync == 0:
+            full_sync_followings(cl, username, session_path)
+        else:
+            incremental_sync_followings(cl, queue, session_path)
+            if time.time() - last_full_sync > FOLLOWINGS_FULL_SYNC_HOURS * 3600:
+                start_background_full_sync(cl, username)
+        print(f"[Комментирование Подписок] В очереди {queue_size(queue)} подписок.")
+
+        prefetched = None
+        if DISCOVERY_SOURCE == "timeline":
+            try:
+                prefetched = fetch_timeline_posts(cl, queue)
+            except Exception as e:
+                log_error(f"[Лента] Ошибка get_timeline_feed: {e}, переходим на опрос по пользователям.")
+
+        if prefetched is not None:
+            final_list = list(prefetched)
+        else:
+            final_list = queue_schedule(queue) if SCHEDULER_ENABLED else queue_snapshot(queue)
+        daemon_set_plan(final_list, queue_size(queue))
+
+        print(f"[Журнал] Посты по стадиям: {journal_counts()}")
+        drain_outbox(cl, config, ai_client, commented_index)
+
+        if PIPELINE_ENABLED:
+            run_pipeline(cl, config, ai_client, queue, commented_index, final_list, prefetched)
+        else:
+            run_sequential(cl, config, ai_client, queue, commented_index, final_list, prefetched)
+
+        drain_outbox(cl, config, ai_client, commented_index)
+    finally:
+        discard_prepared_images()  # Кандидаты, не дошедшие до OpenAI (/drain, ошибка прохода)
+        queue.close()
+
+# ----------------------------------------------------
+# 20. РЕЖИМ ДЕМОНА
+# ----------------------------------------------------
+
+# --daemon: вход, клиенты Instagram и OpenAI и очередь подписок живут всё время работы, проходы по подпискам
+# повторяются каждые DAEMON_PASS_INTERVAL минут. Параметры из DAEMON_RELOADABLE читаются из DAEMON_SETTINGS_FILE
+# и применяются без перезапуска - со следующего пользователя или комментария; файл с ошибкой не применяется целиком.
+# API управления на 127.0.0.1:DAEMON_CONTROL_PORT:
+#   GET  /status             - состояние, текущий пользователь, счётчики, посты журнала по стадиям
+#   GET  /queue              - оставшийся план прохода, пользователи по запросу, outbox
+#   POST /pause, /resume     - пауза перед следующим пользователем или комментарием
+#   POST /drain              - не начинать нового и завершиться; готовые комментарии остаются в журнале
+#   POST /process?user=NAME  - обработать пользователя вне очереди
+# Без --daemon пауз и запросов не бывает, и daemon_users просто отдаёт план прохода.
+
+DAEMON_CONTROL = threading.Condition()
+DAEMON_STATE = {
+    "paused": False, "draining": False, "requested": [], "current": None, "plan": [], "position": 0,
+    "queue_size": 0, "passes": 0, "phase": "starting", "next_pass": 0, "settings_mtime": 0, "settings_error": None,
+}
+
+def daemon_wait():
+    # Ждёт, пока демон на паузе. False - получен /drain, новую работу не начинаем
+    with DAEMON_CONTROL:
+        if DAEMON_STATE["paused"] and not DAEMON_STATE["draining"]:
+            print("[ДЕМОН] Пауза, ждём /resume.")
+        DAEMON_CONTROL.wait_for(lambda: not DAEMON_STATE["paused"] or DAEMON_STATE["draining"])
+        return not DAEMON_STATE["draining"]
+
+def daemon_users(final_list):
+    # Пользователи прохода; запрошенные через /process идут раньше плана
+    with DAEMON_CONTROL:
+        DAEMON_STATE["position"] = 0
+    while daemon_wait():
+        with DAEMON_CONTROL:
+            if DAEMON_STATE["requested"]:
+                user = DAEMON_STATE["requested"].pop(0)
+            elif DAEMON_STATE["position"] < len(final_list):
+                user = final_list[DAEMON_STATE["position"]]
+                DAEMON_STATE["position"] += 1
             else:
-                with open(followings_file, 'r') as f:
-                    lines = [x.strip() for x in f if x.strip() != user]
-                lines.append(user)
-                with open(followings_file, 'w') as f:
-                    for line_ in lines:
-                        f.write(line_ + "\n")
+                return
+            DAEMON_STATE["current"] = user
+        yield user
+
+def daemon_set_plan(final_list, size):
+    with DAEMON_CONTROL:
+        DAEMON_STATE.update(plan=list(final_list), position=0, queue_size=size)
+
+def daemon_command(command, user=None):
+    with DAEMON_CONTROL:
+        if command == "pause":
+            DAEMON_STATE["paused"] = True
+        elif command == "resume":
+            DAEMON_STATE["paused"] = False
+        elif command == "drain":
+            DAEMON_STATE["draining"] = True
+        elif command == "process":
+            if user not in DAEMON_STATE["requested"]:
+                DAEMON_STATE["requested"].append(user)
+        DAEMON_CONTROL.notify_all()
+    metric_inc("daemon_commands_total", command=command)
+    print(f"[ДЕМОН] Команда {command}{' ' + user if user else ''}.")
+
+def daemon_status():
+    with DAEMON_CONTROL:
+        if DAEMON_STATE["draining"]:
+            state = "draining"
+        elif DAEMON_STATE["paused"]:
+            state = "paused"
+        else:
+            state = DAEMON_STATE["phase"]
+        status = {
+            "state": state,
+            "passes": DAEMON_STATE["passes"],
+            "current": DAEMON_STATE["current"],
+            "next_pass": DAEMON_STATE["next_pass"] or None,
+            "queue_size": DAEMON_STATE["queue_size"],
+            "settings_file": DAEMON_SETTINGS_FILE,
+            "settings_error": DAEMON_STATE["settings_error"],
+        }
+    status.update(WORKER_COUNTERS)
+    status["journal"] = journal_counts() if _journal_conn is not None else {}
+    return status
+
+def daemon_queue():
+    with DAEMON_CONTROL:
+        remaining = DAEMON_STATE["plan"][DAEMON_STATE["position"]:]
+        queue = {
+            "requested": list(DAEMON_STATE["requested"]),
+            "plan_total": len(DAEMON_STATE["plan"]),
+            "plan_remaining": len(remaining),
+            "next_users": remaining[:100],
+        }
+    entries = journal_due(until=float("inf")) if _journal_conn is not None else []
+    queue["outbox"] = [
+        {k: entry[k] for k in ("media_id", "user", "state", "liked", "attempts", "next_attempt", "last_error")}
+        for entry in entries
+    ]
+    return queue
+
+# Параметры, вычисляемые из других: пересчитываются при перезагрузке, если не заданы в файле явно
+DAEMON_DERIVED = {
+    "SCHEDULER_MAX_SKIP_HOURS": lambda: POST_CUTOFF_HOURS / 2,
+    "OUTBOX_MAX_AGE_HOURS": lambda: POST_CUTOFF_HOURS * 2,
+}
+# Счётчики (range, срезы, amount): дробное значение для них бессмысленно, 3.0 приводится к 3
+DAEMON_COUNTS = (
+    "SUBSCRIPTIONS_POSTS_AMOUNT", "TIMELINE_MAX_PAGES", "CAROUSEL_MAX_RESOURCES", "POST_TOKEN_BUDGET",
+    "CAPTION_TOKEN_BUDGET", "OUTBOX_MAX_ATTEMPTS", "THRESHOLD_LENGTH_FOR_COMMENTING",
+)
+
+def apply_daemon_settings(settings):
+    # Сначала проверяем весь файл, потом применяем: либо всё, либо ничего
+    if not isinstance(settings, dict):
+        raise ValueError("ожидается объект {\"ИМЯ\": значение}")
+    changed = {}
+    for name, value in settings.items():
+        if name not in DAEMON_RELOADABLE:
+            raise ValueError(f"{name} нельзя менять без перезапуска")
+        current = globals()[name]
+        numeric = isinstance(current, (int, float)) and not isinstance(current, bool)
+        expected = (int, float) if numeric else type(current)
+        if isinstance(value, bool) != isinstance(current, bool) or not isinstance(value, expected):
+            expected_name = "число" if numeric else type(current).__name__
+            raise ValueError(f"{name}: ожидается {expected_name}, получено {value!r}")
+        if name in DAEMON_COUNTS:
+            if not float(value).is_integer():
+                raise ValueError(f"{name}: ожидается целое число, получено {value!r}")
+            value = int(value)
+        if value != current:
+            changed[name] = value
+    globals().update(changed)
+    for name, derive in DAEMON_DERIVED.items():
+        if name not in settings and globals()[name] != derive():
+            changed[name] = globals()[name] = derive()
+    return changed
+
+def reload_daemon_settings(path):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return
+    if mtime == DAEMON_STATE["settings_mtime"]:
+        return
+    DAEMON_STATE["settings_mtime"] = mtime
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            changed = apply_daemon_settings(json.load(f))
+    except (OSError, ValueError) as e:
+        DAEMON_STATE["settings_error"] = str(e)
+        log_error(f"[ДЕМОН] {path} не применён: {e}")
+        return
+    DAEMON_STATE["settings_error"] = None
+    if changed:
+        print(f"[ДЕМОН] Применены параметры из {path}: {', '.join(f'{k}={v!r}' for k, v in changed.items())}")
+
+def watch_daemon_settings(path):
+    def run():
+        while True:
+            time.sleep(DAEMON_SETTINGS_POLL)
+            reload_daemon_settings(path)
+
+    threading.Thread(target=run, name="settings-watch", daemon=True).start()
+
+class _ControlHandler(http.server.BaseHTTPRequestHandler):
+    def _reply(self, code, data):
+        body = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/status":
+            self._reply(200, daemon_status())
+        elif path == "/queue":
+            self._reply(200, daemon_queue())
+        else:
+            self._reply(404, {"error": "GET /status, /queue"})
+
+    def do_POST(self):
+        path, _, query = self.path.partition("?")
+        command = path.strip("/")
+        if command in ("pause", "resume", "drain"):
+            daemon_command(command)
+            self._reply(200, daemon_status())
+        elif command == "process":
+            user = parse_qs(query).get("user", [""])[0].strip().lstrip("@")
+            if not user:
+                self._reply(400, {"error": "нужен параметр user"})
+                return
+            daemon_command("process", user)
+            self._reply(202, {"requested": user})
+        else:
+            self._reply(404, {"error": "POST /pause, /resume, /drain, /process?user=NAME"})
+
+    def log_message(self, *args):
+        pass
 
-        idx += 1
-        random_delay(RANDOM_DELAY_MIN_BETWEEN_USERS, RANDOM_DELAY_MAX_BETWEEN_USERS)
+def start_control_api(port):
+    try:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), _ControlHandler)
+    except OSError as e:
+        log_error(f"[ДЕМОН] Не удалось открыть порт {port} для API управления: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="control-http", daemon=True).start()
+    print(f"[ДЕМОН] API управления на http://127.0.0.1:{port}/status")
+    return server
+
+def run_daemon(cl, config, ai_client):
+    reload_daemon_settings(DAEMON_SETTINGS_FILE)
+    watch_daemon_settings(DAEMON_SETTINGS_FILE)
+    start_control_api(DAEMON_CONTROL_PORT)
+
+    # Индекс и журнал открываются один раз: на каждом проходе заново - утечка дескрипторов и блокировок dbm
+    session_path = config['Session']['path']
+    commented_index = open_commented_index(session_path)
+    open_journal(session_path)
+    try:
+        daemon_loop(cl, config, ai_client, commented_index)
+    finally:
+        close_journal()
+        close_commented_index(commented_index)
+    print("[ДЕМОН] Завершаемся по /drain.")
+
+def daemon_loop(cl, config, ai_client, commented_index):
+    users = None  # None - полный проход, список - только запрошенные через /process
+    while daemon_wait():
+        with DAEMON_CONTROL:
+            DAEMON_STATE["phase"] = "running"
+            if users is None:
+                DAEMON_STATE["passes"] += 1
+        try:
+            logic_comment_followings(cl, config, ai_client, users, commented_index)
+        except Exception as e:
+            log_error(f"[ДЕМОН] Проход завершился ошибкой: {e}")
+
+        idle_since = time.time()
+        with DAEMON_CONTROL:
+            DAEMON_STATE.update(phase="idle", current=None)
+            while not DAEMON_STATE["draining"] and not DAEMON_STATE["requested"]:
+                # DAEMON_PASS_INTERVAL перечитывается на каждом круге: его могли поменять в файле параметров
+                DAEMON_STATE["next_pass"] = idle_since + DAEMON_PASS_INTERVAL * 60
+                if time.time() >= DAEMON_STATE["next_pass"]:
+                    break
+                DAEMON_CONTROL.wait(min(DAEMON_STATE["next_pass"] - time.time(), DAEMON_SETTINGS_POLL))
+            users = [] if DAEMON_STATE["requested"] and time.time() < DAEMON_STATE["next_pass"] else None
+            DAEMON_STATE["next_pass"] = 0
 
 # ----------------------------------------------------
-# 11. MAIN
+# 21. СУПЕРВИЗОР НЕСКОЛЬКИХ АККАУНТОВ
 # ----------------------------------------------------
 
-def main():
-    session_path = None
-    while not session_path:
-        session_path = select_session()
-    if not session_path:
-        print("[ERROR] Не удалось выбрать/создать сессию.")
+# Супервизор запускает по процессу на каждую папку в Sessions/, перезапускает упавшие,
+# делит между ними OpenAI (OPENAI_GATE / OPENAI_SPEND) и собирает их статусы в одну таблицу.
+
+WORKER_STATUS = None
+WORKER_NAME = None
+WORKER_STOP = None  # Событие супервизора: пора сохранить учёт OpenAI и завершиться
+WORKER_COUNTERS = {"comments": 0, "users": 0}
+
+def report_status(**fields):
+    if WORKER_STATUS is None:
         return
+    try:
+        status = dict(WORKER_STATUS.get(WORKER_NAME, {}))
+        status.update(fields)
+        status["updated"] = int(time.time())
+        WORKER_STATUS[WORKER_NAME] = status
+    except Exception:
+        pass  # Супервизор уже завершился
+
+def list_sessions():
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
+    return sorted(
+        name for name in os.listdir(SESSIONS_DIR)
+        if os.path.exists(os.path.join(SESSIONS_DIR, name, 'ig_login.ini'))
+    )
+
+def worker_settings(number):
+    # spawn-воркер заново импортирует скрипт, и параметры командной строки (они в глобальных переменных)
+    # до него не доходят - передаём их явно. Порты у каждого воркера свои: базовый + номер воркера
+    return {
+        "PROFILER_SAMPLE_INTERVAL": PROFILER_SAMPLE_INTERVAL,
+        "METRICS_HTTP_PORT": METRICS_HTTP_PORT + number if METRICS_HTTP_PORT else 0,
+        "DAEMON_SETTINGS_FILE": DAEMON_SETTINGS_FILE,
+        "DAEMON_CONTROL_PORT": DAEMON_CONTROL_PORT + number,
+    }
+
+def run_worker(session_path, gate, gate_held, spend, status, stop, settings, daemon):
+    global OPENAI_GATE, OPENAI_GATE_HELD, OPENAI_SPEND, WORKER_STATUS, WORKER_NAME, WORKER_STOP
+    OPENAI_GATE, OPENAI_GATE_HELD, OPENAI_SPEND, WORKER_STATUS, WORKER_STOP = gate, gate_held, spend, status, stop
+    globals().update(settings)
+    WORKER_NAME = os.path.basename(session_path)
+    report_status(state="login")
+    run_session(session_path, daemon=daemon)
+
+def watch_worker_stop(config):
+    # По сигналу супервизора сразу сбрасываем буфер учёта OpenAI и прерываем основной поток,
+    # дальше run_session завершается как по Ctrl+C
+    def run():
+        WORKER_STOP.wait()
+        print("[INFO] Супервизор останавливает воркер.")
+        flush_openai_usage(config)
+        if hasattr(signal, "pthread_kill"):
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)  # Прерывает и time.sleep
+        else:
+            _thread.interrupt_main()
 
+    threading.Thread(target=run, name="worker-stop", daemon=True).start()
+
+def reclaim_gate(gate, gate_held, pid):
+    # Воркер умер, держа места семафора (запрос к OpenAI в полёте, terminate) - возвращаем их,
+    # иначе после SUPERVISOR_OPENAI_CONCURRENCY таких падений все воркеры навсегда встанут в acquire_gate
+    held = gate_held.pop(pid, 0)
+    for _ in range(held):
+        try:
+            gate.release()
+        except ValueError:
+            break  # Семафор уже полон
+    if held:
+        log_error(f"[SUPERVISOR] Возвращено {held} мест семафора OpenAI от воркера pid={pid}.")
+
+def print_supervisor_status(status, spend):
+    snapshot = dict(status)
+    print(f"[SUPERVISOR] {datetime.now():%Y-%m-%d %H:%M:%S}, OpenAI ${spend.value:.4f}")
+    print(f"{'session':<20} {'state':<10} {'pid':>7} {'restarts':>8} {'users':>6} {'comments':>8}  user")
+    for name in sorted(snapshot):
+        st = snapshot[name]
+        print(f"{name:<20} {st.get('state', ''):<10} {st.get('pid', 0):>7} {st.get('restarts', 0):>8} "
+              f"{st.get('users', 0):>6} {st.get('comments', 0):>8}  {st.get('user', '')}")
+    with open(os.path.join(LOGS_DIR, 'supervisor_status.json'), 'w', encoding='utf-8') as f:
+        json.dump({"openai_spend": spend.value, "sessions": snapshot}, f, ensure_ascii=False, indent=2)
+
+def run_supervisor(daemon=False):
+    sessions = list_sessions()
+    if not sessions:
+        print("[SUPERVISOR] В Sessions/ нет ни одной сессии.")
+        return
+    print(f"[SUPERVISOR] Запускаем {len(sessions)} воркеров: {', '.join(sessions)}")
+
+    ctx = multiprocessing.get_context("spawn")
+    manager = ctx.Manager()
+    status = manager.dict()
+    gate = ctx.BoundedSemaphore(SUPERVISOR_OPENAI_CONCURRENCY)
+    gate_held = manager.dict()
+    spend = ctx.Value('d', 0.0)
+    stop = ctx.Event()
+
+    workers = {}  # name -> {"proc", "settings", "started", "crashes", "restart_at"}
+    for number, name in enumerate(sessions, 1):
+        workers[name] = {"proc": None, "settings": worker_settings(number), "started": 0, "crashes": 0, "restart_at": 0}
+        status[name] = {"state": "starting", "restarts": 0}
+
+    last_status = 0
+    try:
+        while True:
+            now = time.time()
+            for name, w in workers.items():
+                proc = w["proc"]
+                if proc is not None and not proc.is_alive():
+                    proc.join()
+                    reclaim_gate(gate, gate_held, proc.pid)
+                    st = dict(status.get(name, {}))
+                    if proc.exitcode == 0:
+                        st["state"] = "finished"
+                        w["restart_at"] = None
+                    else:
+                        # Воркер, проработавший больше 10 минут, начинает отсчёт падений заново
+                        w["crashes"] = 1 if now - w["started"] > 600 else w["crashes"] + 1
+                        delay = min(SUPERVISOR_RESTART_DELAY * 2 ** (w["crashes"] - 1), 3600)
+                        w["restart_at"] = now + delay
+                        st["state"] = "crashed"
+                        log_error(f"[SUPERVISOR] Воркер {name} упал (exitcode={proc.exitcode}), перезапуск через {delay}с.")
+                    status[name] = st
+                    w["proc"] = None
+
+                if w["proc"] is None and w["restart_at"] is not None and now >= w["restart_at"]:
+                    proc = ctx.Process(
+                        target=run_worker, name=f"worker-{name}",
+                        args=(os.path.join(SESSIONS_DIR, name), gate, gate_held, spend, status, stop,
+                              w["settings"], daemon)
+                    )
+                    proc.start()
+                    st = dict(status.get(name, {}))
+                    if w["started"]:
+                        st["restarts"] = st.get("restarts", 0) + 1
+                    st.update(state="running", pid=proc.pid)
+                    status[name] = st
+                    w.update(proc=proc, started=now)
+
+            if SUPERVISOR_COST_BUDGET > 0 and spend.value >= SUPERVISOR_COST_BUDGET:
+                log_error(f"[SUPERVISOR] Бюджет OpenAI ${SUPERVISOR_COST_BUDGET} исчерпан, останавливаем воркеры.")
+                break
+            if all(w["proc"] is None and w["restart_at"] is None for w in workers.values()):
+                print("[SUPERVISOR] Все воркеры завершили работу.")
+                break
+            if now - last_status >= SUPERVISOR_STATUS_INTERVAL:
+                print_supervisor_status(status, spend)
+                last_status = now
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("[SUPERVISOR] Остановлен пользователем.")
+    finally:
+        # Сначала просим воркеры завершиться самим (с сохранением учёта), terminate - только для зависших
+        stop.set()
+        deadline = time.time() + SUPERVISOR_STOP_TIMEOUT
+        for w in workers.values():
+            if w["proc"] is not None:
+                w["proc"].join(max(0, deadline - time.time()))
+        for w in workers.values():
+            if w["proc"] is not None and w["proc"].is_alive():
+                log_error(f"[SUPERVISOR] Воркер {w['proc'].name} не завершился за {SUPERVISOR_STOP_TIMEOUT}с, terminate.")
+                w["proc"].terminate()
+                w["proc"].join(30)
+        print_supervisor_status(status, spend)
+        manager.shutdown()
+        shutdown_telegram()
+
+# ----------------------------------------------------
+# 22. MAIN
+# ----------------------------------------------------
+
+def run_session(session_path, daemon=False):
     cl, config = init_instagram_client(session_path)
     if not cl:
         print("[ERROR] Не удалось войти в Instagram.")
         return
 
     try:
-        ai_client = OpenAI(api_key=OPENAI_API_KEY)
+        ai_client = create_ai_client(OPENAI_API_KEY)
         print("[OPENAI] Инициализирован.")
+        prefix_tokens = max(count_tokens(p) for p in (PROMPT_DESCRIBE_IMAGE, PROMPT_COMMENT, PROMPT_COMMENT_MULTIMODAL))
+        if prefix_tokens < PROMPT_CACHE_MIN_TOKENS:
+            print(f"[OPENAI] Промпты ~{prefix_tokens} токенов, меньше {PROMPT_CACHE_MIN_TOKENS}: кеш префикса не сработает.")
     except Exception as e:
         log_error(f"OpenAI error: {e}")
         return
 
+    start_usage_flusher(config)
+    if WORKER_STOP is not None:
+        watch_worker_stop(config)
+    if METRICS_SNAPSHOT_INTERVAL > 0:
+        start_metrics_snapshots(session_path)
+    if METRICS_HTTP_PORT:
+        start_metrics_exporter(METRICS_HTTP_PORT)
+    report_status(state="running")
     try:
-        logic_comment_followings(cl, config, ai_client)
+        with sampling_profiler(os.path.basename(session_path)):
+            if daemon:
+                run_daemon(cl, config, ai_client)
+            else:
+                logic_comment_followings(cl, config, ai_client)
     except KeyboardInterrupt:
         print("[INFO] Программа была остановлена пользователем.")
     finally:
+        flush_openai_usage(config)
+        write_metrics_snapshot(session_path)
+        shutdown_telegram()
         print("[INFO] Программа завершается.")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Комментирование постов подписок Instagram")
+    parser.add_argument("--session", default=IG_SESSION or None,
+                        help="Имя сессии в Sessions/ (без интерактивного выбора), по умолчанию $IG_SESSION")
+    parser.add_argument("--new-session", metavar="NAME",
+                        help="Создать сессию и сразу запустить её; логин и пароль из $IG_LOGIN / $IG_PASSWORD")
+    parser.add_argument("--openai-key", help="Ключ OpenAI (по умолчанию $OPENAI_API_KEY)")
+    parser.add_argument("--supervisor", action="store_true", help="Запустить по воркеру на каждую сессию в Sessions/")
+    parser.add_argument("--metrics-port", type=int, help="Порт для метрик Prometheus на 127.0.0.1 (METRICS_HTTP_PORT), у воркеров супервизора - порт + номер воркера")
+    parser.add_argument("--profile", type=float, metavar="SECONDS", help="Включить сэмплирующий профайлер с этим периодом")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Работать постоянно: проходы каждые DAEMON_PASS_INTERVAL минут, API управления, перечитывание параметров")
+    parser.add_argument("--settings", help="Файл параметров для --daemon (DAEMON_SETTINGS_FILE)")
+    parser.add_argument("--control-port", type=int, help="Порт API управления для --daemon (DAEMON_CONTROL_PORT)")
+    return parser.parse_args()
+
+def main():
+    global METRICS_HTTP_PORT, PROFILER_SAMPLE_INTERVAL, OPENAI_API_KEY, DAEMON_SETTINGS_FILE, DAEMON_CONTROL_PORT
+    args = parse_args()
+    if args.openai_key:
+        # Через окружение ключ дойдёт и до воркеров супервизора (spawn заново импортирует скрипт)
+        OPENAI_API_KEY = os.environ["OPENAI_API_KEY"] = args.openai_key
+    if args.metrics_port is not None:
+        METRICS_HTTP_PORT = args.metrics_port
+    if args.profile is not None:
+        PROFILER_SAMPLE_INTERVAL = args.profile
+    if args.settings:
+        DAEMON_SETTINGS_FILE = args.settings
+    if args.control_port is not None:
+        DAEMON_CONTROL_PORT = args.control_port
+    if args.supervisor:
+        run_supervisor(daemon=args.daemon)
+        return
+
+    if args.new_session:
+        if not is_interactive() and not (IG_LOGIN and IG_PASSWORD):
+            print("[ERROR] Для --new-session без терминала задайте $IG_LOGIN и $IG_PASSWORD.")
+            return
+        session_path = create_new_session(args.new_session, IG_LOGIN or None, IG_PASSWORD or None)
+    elif args.session:
+        session_path = os.path.join(SESSIONS_DIR, args.session)
+        if not os.path.exists(os.path.join(session_path, 'ig_login.ini')):
+            print(f"[ERROR] Сессия {args.session} не найдена.")
+            return
+    elif not is_interactive():
+        print("[ERROR] Нет терминала для выбора сессии: укажите --session, $IG_SESSION или --new-session.")
+        return
+    else:
+        session_path = None
+        while not session_path:
+            session_path = select_session()
+    if not session_path:
+        print("[ERROR] Не удалось выбрать/создать сессию.")
+        return
+
+    run_session(session_path, daemon=args.daemon)
+
 if __name__ == "__main__":
     main()